@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark for the per-send encoding overhead of Bot API requests
+# Sends replies through application.bot (ExtBot -> TimedRequest -> httpx) to a
+# MockTransport that answers instantly, in alternating rounds with PAYLOAD_CACHE
+# off and on, and checks that both paths put the same form body on the wire.
+#
+# Usage: python3 bench/bench_encoding.py [--sends N] [--rounds N]
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+sys.path.insert(0, BOT_DIR)
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+
+import httpx
+
+CHAT_ID = 100500
+RESPONSE = b'{"ok": true, "result": {"message_id": 1, "date": 0, "chat": {"id": 100500, "type": "private"}}}'
+GET_ME = b'{"ok": true, "result": {"id": 1, "is_bot": true, "first_name": "Bench", "username": "bench_bot"}}'
+bodies = []
+
+
+async def telegram_api(request):
+    if request.url.path.endswith("/getMe"):
+        return httpx.Response(200, content=GET_ME)
+    bodies.append(await request.aread())
+    return httpx.Response(200, content=RESPONSE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure Bot API request encoding with and without the payload cache")
+    parser.add_argument("--sends", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5, help="alternating cache off/on rounds, the fastest is reported")
+    args = parser.parse_args()
+
+    import lambda_function
+    bot = lambda_function.application.bot
+    # Time the encoding, not FloodControl's pacing of one chat
+    bot._rate_limiter = None
+    for request in bot._request:
+        request._client_kwargs["transport"] = httpx.MockTransport(telegram_api)
+        request._client = request._build_client()
+    lambda_function.deadline = lambda_function.Deadline(15 * 60 * 1000)
+
+    cases = {
+        "fixed text + keyboard": lambda i: bot.send_message(CHAT_ID, "Unknown action!", reply_markup=lambda_function.MAIN_KEYBOARD),
+        "dynamic text + keyboard": lambda i: bot.send_message(CHAT_ID, f"Instance Information:\nState: running #{i}", reply_markup=lambda_function.MAIN_KEYBOARD),
+        "text only": lambda i: bot.send_message(CHAT_ID, "Unknown action!"),
+    }
+
+    async def run(send):
+        for i in range(args.sends):
+            await send(i)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(bot.initialize())
+    print(f"{'request':<26}{'no cache us':>12}{'cache us':>10}  same body")
+    for name, send in cases.items():
+        results, wire = {False: float("inf"), True: float("inf")}, {}
+        for _ in range(args.rounds):
+            for cached in (False, True):
+                lambda_function.PAYLOAD_CACHE = cached
+                bodies.clear()
+                started = time.perf_counter()
+                loop.run_until_complete(run(send))
+                results[cached] = min(results[cached], (time.perf_counter() - started) / args.sends * 1e6)
+                wire[cached] = bodies[-1]
+        print(f"{name:<26}{results[False]:>12.1f}{results[True]:>10.1f}  {wire[False] == wire[True]}")
+    loop.run_until_complete(bot.shutdown())
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark for bot/lambda_function.py
+# Drives lambda_handler with webhook payloads for every button, with local
+# stand-ins for all outbound calls:
+# - EC2: botocore Stubber on the bot's clients, answering from a fake instance
+# - SSH/SFTP: in-process paramiko server (ServerInterface + SFTPServer)
+# - Telegram: httpx.MockTransport on the bot's HTTPXRequest objects
+# Reports per-action p50/p95 latency and outbound calls per invocation.
+#
+# Usage: python3 bench/bench_handlers.py [--iterations N] [--remaining-ms MS] [--ec2-latency MS]
+#                                         [--ssh-latency MS] [--telegram-latency MS]
+
+import argparse
+import asyncio
+import base64
+import fnmatch
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bot")
+sys.path.insert(0, BOT_DIR)
+
+# Fake credentials so boto3 can build clients without touching AWS
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+
+import httpx
+import paramiko
+from botocore.stub import Stubber
+
+CHAT_ID = 100500
+SPAM_CHAT_ID = 666  # A chat the bot does not serve
+INSTANCE_ID = "i-0123456789abcdef0"
+PEERS = 7
+BUTTONS = ["/start", "Start EC2", "Stop EC2", "Check Status", "Get Peer Files", "peer3", "All peers", "Recreate Peers", "/rotate 3", "Unknown", "Spam", "/timings"]
+
+# Outbound calls made during the current invocation, keyed "service:operation"
+calls = Counter()
+calls_lock = threading.Lock()
+
+def count(name, amount=1):
+    with calls_lock:
+        calls[name] += amount
+
+# Injected latencies in seconds (set from the command line)
+latency = {"ec2": 0.0, "ssh": 0.0, "telegram": 0.0}
+
+
+# EC2 stand-in: a Stubber that builds each response from a fake instance
+# instead of a pre-recorded queue, so handlers may call EC2 in any order
+class FakeEC2(Stubber):
+    instance = {"state": "stopped", "hibernated": False}
+    fleet = 0  # With --fleet N: N instances tagged alike, all in the state above
+    multi_region = False  # With --regions: count StartInstances per region
+
+    # Keep the API-level parameters, before-call only sees the serialized request
+    def _assert_expected_params(self, model, params, context, **kwargs):
+        context["bench_params"] = params
+
+    def _get_response_handler(self, model, params, context, **kwargs):
+        count(f"ec2:{model.name}")
+        time.sleep(latency["ec2"])
+        method = self.client.meta.method_to_api_mapping
+        method = next(name for name, api in method.items() if api == model.name)
+        self._add_response(method, self.respond(model.name, context.get("bench_params", {})), None)
+        return super()._get_response_handler(model, params, context, **kwargs)
+
+    def respond(self, operation, params):
+        instance = FakeEC2.instance
+        if operation == "StartInstances":
+            count("ec2:instances_started", len(params["InstanceIds"]))
+            if FakeEC2.multi_region:
+                count(f"ec2:started_in:{self.client.meta.region_name}")
+            previous, instance["state"] = instance["state"], "running"
+            return {"StartingInstances": [self.change(previous, "pending", i) for i in params["InstanceIds"]]}
+        if operation == "StopInstances":
+            count("ec2:instances_stopped", len(params["InstanceIds"]))
+            previous, instance["state"] = instance["state"], "stopped"
+            instance["hibernated"] = params.get("Hibernate", False)
+            return {"StoppingInstances": [self.change(previous, "stopping", i) for i in params["InstanceIds"]]}
+        if operation == "DescribeInstances":
+            for f in params.get("Filters", []):
+                if f["Name"] == "instance-state-name" and instance["state"] not in f["Values"]:
+                    return {"Reservations": []}
+            if not FakeEC2.fleet:
+                return {"Reservations": [{"ReservationId": "r-bench", "Instances": [self.describe()]}]}
+            # One reservation per instance, MaxResults per page
+            start = int(params.get("NextToken", 0))
+            end = min(FakeEC2.fleet, start + params.get("MaxResults", FakeEC2.fleet))
+            response = {"Reservations": [{"ReservationId": f"r-bench{i:04d}", "Instances": [self.describe(i)]} for i in range(start, end)]}
+            if end < FakeEC2.fleet:
+                response["NextToken"] = str(end)
+            return response
+        raise NotImplementedError(operation)
+
+    def describe(self, index=None):
+        state = FakeEC2.instance["state"]
+        codes = {"pending": 0, "running": 16, "stopping": 64, "stopped": 80}
+        described = {
+            "InstanceId": INSTANCE_ID if index is None else f"i-bench{index:012d}",
+            "InstanceType": "t3.micro",
+            "State": {"Code": codes[state], "Name": state},
+            "Tags": [{"Key": "Name", "Value": "bench" if index is None else f"bench-{index + 1:02d}"}],
+            "HibernationOptions": {"Configured": True},
+        }
+        if state == "stopped" and FakeEC2.instance["hibernated"]:
+            described["StateReason"] = {"Code": "Client.UserInitiatedHibernate", "Message": "Client.UserInitiatedHibernate: User initiated hibernate"}
+        if state == "running":
+            described["PublicIpAddress"] = "127.0.0.1"
+        return described
+
+    def change(self, previous, current, instance_id=INSTANCE_ID):
+        codes = {"pending": 0, "running": 16, "stopping": 64, "stopped": 80}
+        return {
+            "InstanceId": instance_id,
+            "PreviousState": {"Code": codes[previous], "Name": previous},
+            "CurrentState": {"Code": codes[current], "Name": current},
+        }
+
+
+# DynamoDB stand-in for PERSISTENCE_TABLE: one in-memory table keyed by (kind, id)
+class FakeDynamoDB(FakeEC2):
+    table = {}
+
+    def _get_response_handler(self, model, params, context, **kwargs):
+        count(f"dynamodb:{model.name}")
+        time.sleep(latency["ec2"])
+        method = self.client.meta.method_to_api_mapping
+        method = next(name for name, api in method.items() if api == model.name)
+        self._add_response(method, self.respond(model.name, context.get("bench_params", {})), None)
+        return Stubber._get_response_handler(self, model, params, context, **kwargs)
+
+    def respond(self, operation, params):
+        if operation == "Scan":
+            return {"Items": list(FakeDynamoDB.table.values()), "Count": len(FakeDynamoDB.table)}
+        if operation == "BatchWriteItem":
+            for requests in params["RequestItems"].values():
+                for request in requests:
+                    if "PutRequest" in request:
+                        item = request["PutRequest"]["Item"]
+                        FakeDynamoDB.table[(item["kind"]["S"], item["id"]["S"])] = item
+                        count("dynamodb:bytes_written", len(item["data"]["S"]))
+                    else:
+                        key = request["DeleteRequest"]["Key"]
+                        FakeDynamoDB.table.pop((key["kind"]["S"], key["id"]["S"]), None)
+            return {"UnprocessedItems": {}}
+        raise NotImplementedError(operation)
+
+
+# SSH stand-in: files live in memory, keyed by absolute path
+remote_files = {}
+
+def make_peers(peers_dir):
+    remote_files.clear()
+    for i in range(1, PEERS + 1):
+        remote_files[f"{peers_dir}/peer{i}/peer{i}.conf"] = (
+            f"[Interface]\nAddress = 10.13.13.{i + 1}\nPrivateKey = {'A' * 43}=\nDNS = 172.20.0.2\n\n"
+            f"[Peer]\nPublicKey = {'B' * 43}=\nPresharedKey = {'C' * 43}=\n"
+            f"Endpoint = 127.0.0.1:51820\nAllowedIPs = 0.0.0.0/0, ::/0\n"
+        ).encode()
+        # Container QR codes are ~1-2 KB PNGs
+        remote_files[f"{peers_dir}/peer{i}/peer{i}.png"] = b"\x89PNG\r\n\x1a\n" + os.urandom(1500)
+
+
+class FakeSFTP(paramiko.SFTPServerInterface):
+    def list_folder(self, path):
+        count("sftp:listdir")
+        time.sleep(latency["ssh"])
+        prefix = path.rstrip("/") + "/"
+        names = {p[len(prefix):].split("/")[0] for p in remote_files if p.startswith(prefix)}
+        if not names:
+            return paramiko.SFTP_NO_SUCH_FILE
+        entries = []
+        for name in sorted(names):
+            attr = paramiko.SFTPAttributes()
+            attr.filename = name
+            attr.st_mode = 0o40755
+            entries.append(attr)
+        return entries
+
+    def stat(self, path):
+        if path not in remote_files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = len(remote_files[path])
+        attr.st_mode = 0o100644
+        return attr
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        count("sftp:open")
+        time.sleep(latency["ssh"])
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            handle = WrittenFile(flags)
+            handle.filename = path
+            handle.writefile = io.BytesIO()
+            return handle
+        if path not in remote_files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        count("sftp:bytes", len(remote_files[path]))
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = io.BytesIO(remote_files[path])
+        return handle
+
+
+# Uploaded file: lands in remote_files when the client closes it
+class WrittenFile(paramiko.SFTPHandle):
+    def close(self):
+        remote_files[self.filename] = self.writefile.getvalue()
+        count("sftp:bytes_written", len(remote_files[self.filename]))
+        super().close()
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+    def __init__(self, peers_dir):
+        self.peers_dir = peers_dir
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OR_UNKNOWN
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def run_command(self, channel, command):
+        count("ssh:exec")
+        time.sleep(latency["ssh"])
+        output, status = b"", 0
+        if command == "uptime":
+            output = b" 12:00:00 up 1:23,  0 users,  load average: 0.00, 0.00, 0.00\n"
+        elif command.startswith("rm -rf "):
+            for target in command.split()[2:]:
+                target = target.rstrip("/")
+                for path in [p for p in remote_files if fnmatch.fnmatch(p, target) or fnmatch.fnmatch(p, target + "/*")]:
+                    del remote_files[path]
+        elif " tar -xf " in command:
+            # cd PEERS_DIR && tar -xf UPLOAD && rm -f UPLOAD STALE... && docker exec wireguard sh -c '...'
+            words = command.split(" && ")
+            peers_dir, upload = words[0].split()[1], words[1].split()[2]
+            with tarfile.open(fileobj=io.BytesIO(remote_files.pop(upload))) as tar:
+                for member in tar.getmembers():
+                    remote_files[f"{peers_dir}/{member.name}"] = tar.extractfile(member).read()
+            for stale in words[2].split()[3:]:
+                remote_files.pop(f"{peers_dir}/{stale}", None)
+        elif command.startswith("docker exec wireguard sh -c 'wg show "):
+            # Interface line, then one line per peer (keys are placeholders)
+            output = f"{'S' * 43}=\t{'P' * 43}=\t51820\toff\n".encode()
+            for i in range(1, PEERS + 1):
+                output += f"{chr(64 + i) * 43}=\t(none)\t(none)\t10.13.13.{i + 1}/32\t0\t0\t0\toff\n".encode()
+        elif command.startswith("docker exec wireguard sh -c "):
+            pass  # wg set / wg-quick save
+        elif command.startswith("docker inspect "):
+            output = b"/wireguard running \n/pihole running healthy\n"
+        elif "docker-compose" in command or "docker " in command:
+            make_peers(self.peers_dir)
+        try:
+            channel.sendall(output)
+            channel.send_exit_status(status)
+            channel.close()
+        except (EOFError, OSError):
+            pass  # The client hung up without waiting for the command
+
+
+def serve_ssh(listener, host_key, peers_dir):
+    while True:
+        conn, _ = listener.accept()
+        count("ssh:connect")
+        time.sleep(latency["ssh"])
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, FakeSFTP)
+        try:
+            transport.start_server(server=FakeSSHServer(peers_dir))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()  # Port probes connect and hang up without a banner
+
+
+def start_ssh_server(peers_dir):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    host_key = paramiko.RSAKey.generate(2048)
+    threading.Thread(target=serve_ssh, args=(listener, host_key, peers_dir), daemon=True).start()
+    port = listener.getsockname()[1]
+
+    # The bot connects to port 22 of the instance IP: redirect to the stand-in
+    connect = paramiko.SSHClient.connect
+
+    def connect_to_stand_in(self, hostname, *args, **kwargs):
+        kwargs["port"] = port
+        return connect(self, hostname, *args, **kwargs)
+
+    paramiko.SSHClient.connect = connect_to_stand_in
+    return port
+
+
+# Inline keyboard last sent by the bot: button text -> callback_data as sent to Telegram
+inline_buttons = {}
+
+
+# Telegram flood limit: sends accepted per rolling second before answering 429 (0 = no limit)
+flood_limit = {"sends": 0}
+recent_sends = deque()
+
+
+# Telegram stand-in: answers every Bot API method with a plausible result
+async def telegram_api(request):
+    method = request.url.path.rsplit("/", 1)[-1]
+    body = await request.aread()
+    count(f"telegram:{method}")
+    count("telegram:bytes", len(body))
+    await asyncio.sleep(latency["telegram"])
+    if flood_limit["sends"] and method.startswith("send"):
+        now = time.monotonic()
+        while recent_sends and now - recent_sends[0] > 1:
+            recent_sends.popleft()
+        if len(recent_sends) >= flood_limit["sends"]:
+            count("telegram:429")
+            return httpx.Response(429, json={
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        recent_sends.append(now)
+    if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+        markup = urllib.parse.parse_qs(body.decode()).get("reply_markup")
+        keyboard = json.loads(markup[0]).get("inline_keyboard") if markup else None
+        if keyboard:
+            inline_buttons.clear()
+            inline_buttons.update((button["text"], button["callback_data"]) for row in keyboard for button in row)
+    if method == "getMe":
+        result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+    elif method == "answerCallbackQuery":
+        result = True
+    else:
+        result = {"message_id": 1, "date": int(time.time()), "chat": {"id": CHAT_ID, "type": "private"}}
+    return httpx.Response(200, json={"ok": True, "result": result})
+
+
+def install_telegram_transport(bot):
+    for request in bot._request:
+        request._client_kwargs["transport"] = httpx.MockTransport(telegram_api)
+        request._client = request._build_client()
+
+
+# Recorded webhook payload (API Gateway proxy event) for a button press
+def webhook_event(update_id, text, chat_id=CHAT_ID):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {
+        "resource": "/",
+        "path": "/",
+        "httpMethod": "POST",
+        "headers": {"Content-Type": "application/json", "Host": "bench.execute-api.eu-west-2.amazonaws.com"},
+        "body": json.dumps({"update_id": update_id, "message": message}),
+        "isBase64Encoded": False,
+    }
+
+
+# check_wg.py post, as API Gateway passes it on
+def monitor_event(data):
+    return {
+        "resource": "/",
+        "path": "/",
+        "httpMethod": "POST",
+        "headers": {"Content-Type": "application/json", "X-Monitor-Secret": "bench"},
+        "body": json.dumps(data),
+        "isBase64Encoded": False,
+    }
+
+
+# Recorded webhook payload for a press on the inline keyboard last sent by the bot
+def callback_event(update_id, text):
+    chat = {"id": CHAT_ID, "type": "private", "first_name": "Bench"}
+    query = {
+        "id": str(update_id),
+        "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Bench"},
+        "chat_instance": "bench",
+        "data": inline_buttons[text],
+        "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "Choose a peer:"},
+    }
+    return {
+        "resource": "/",
+        "path": "/",
+        "httpMethod": "POST",
+        "headers": {"Content-Type": "application/json", "Host": "bench.execute-api.eu-west-2.amazonaws.com"},
+        "body": json.dumps({"update_id": update_id, "callback_query": query}),
+        "isBase64Encoded": False,
+    }
+
+
+# Inline keyboard buttons, pressed on the keyboard "Get Peer Files" sends
+INLINE_ACTIONS = {"peer3", "All peers"}
+
+
+# Lambda context stand-in
+class FakeContext:
+    function_name = "wireguard-ec2-bot"
+    aws_request_id = "bench"
+
+    remaining_ms = 30000
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+# Instance state each action expects when pressed
+INITIAL_STATE = {"Start EC2": "stopped"}
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lambda_handler with local EC2, SSH and Telegram stand-ins")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--ec2-latency", type=float, default=0, help="ms per EC2 API call")
+    parser.add_argument("--ssh-latency", type=float, default=0, help="ms per SSH connect/exec/SFTP op")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="ms per Bot API call")
+    parser.add_argument("--remaining-ms", type=int, default=30000, help="Lambda time left at the start of each invocation")
+    parser.add_argument("--actions", nargs="*", default=BUTTONS)
+    parser.add_argument("--recreate-mode", choices=["wireguard", "stack", "native"], default="wireguard", help="RECREATE_MODE for Recreate Peers")
+    parser.add_argument("--download-qr", action="store_true", help="download peerN.png instead of rendering QR codes (RENDER_QR off)")
+    parser.add_argument("--persistence", action="store_true", help="persist bot data in a DynamoDB stand-in (PERSISTENCE_TABLE)")
+    parser.add_argument("--cold-press", action="store_true", help="with --persistence, inline buttons are pressed on a container that did not send the keyboard")
+    parser.add_argument("--flood", type=int, default=0, help="then send N updates from a chat the bot does not serve, back to back")
+    parser.add_argument("--no-pre-dispatch", action="store_true", help="build an Update for every webhook (PRE_DISPATCH off)")
+    parser.add_argument("--no-webhook-reply", action="store_true", help="send every reply through the Bot API (RESPOND_IN_WEBHOOK off)")
+    parser.add_argument("--telegram-flood", type=int, default=0, help="Telegram answers 429 past N sends per second to the chat")
+    parser.add_argument("--no-flood-control", action="store_true", help="send without the rate limiter (FLOOD_CONTROL off)")
+    parser.add_argument("--tenants", type=int, default=0, help="serve N tenants from a TENANTS_FILE (the bench chat is the first), instead of ALLOWED_CHAT_ID")
+    parser.add_argument("--fleet", type=int, default=0, help="FLEET_MODE against N instances behind the tag (all answered by the SSH stand-in)")
+    parser.add_argument("--fleet-workers", type=int, default=8, help="with --fleet, FLEET_WORKERS")
+    parser.add_argument("--regions", help="comma-separated EC2_REGIONS, each answered by its own stubbed client (the instance exists in all)")
+    parser.add_argument("--region-rtt", nargs="*", default=[], metavar="REGION=MS", help="with --regions, peer RTT samples posted as check_wg.py latency events first")
+    parser.add_argument("--hibernate", action="store_true", help="stop with EC2_HIBERNATE on (instance reports hibernation support)")
+    args = parser.parse_args()
+    FakeContext.remaining_ms = args.remaining_ms
+    latency.update(ec2=args.ec2_latency / 1000, ssh=args.ssh_latency / 1000, telegram=args.telegram_latency / 1000)
+    # Clients hanging up on the stand-in server are expected, keep the report readable
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    client_key = paramiko.RSAKey.generate(2048)
+    key_pem = io.StringIO()
+    client_key.write_private_key(key_pem)
+    os.environ["SSH_KEY"] = base64.b64encode(key_pem.getvalue().encode()).decode()
+
+    if args.persistence:
+        os.environ["PERSISTENCE_TABLE"] = "bench-persistence"
+    flood_limit["sends"] = args.telegram_flood
+    if args.tenants:
+        # One instance tag each; only the first matches the EC2 stand-in's instance
+        tenants_file = os.path.join(tempfile.mkdtemp(), "tenants.json")
+        with open(tenants_file, "w") as f:
+            json.dump([{"name": f"team{i}", "chat_ids": [CHAT_ID + i], "tag_value": "bench" if i == 0 else f"bench{i}", "fleet": i == 0 and args.fleet > 0} for i in range(args.tenants)], f)
+        os.environ["TENANTS_FILE"] = tenants_file
+    import lambda_function
+    if args.no_flood_control:
+        # The builder already ran on import: drop the limiter it installed
+        lambda_function.application.bot._rate_limiter = None
+    FakeEC2.fleet = args.fleet
+    lambda_function.fleet_pool = ThreadPoolExecutor(max_workers=args.fleet_workers)
+    if not args.tenants:
+        lambda_function.ALLOWED_CHAT_ID = str(CHAT_ID)  # As configured: a string
+        lambda_function.FLEET_MODE = args.fleet > 0
+        if args.regions:
+            lambda_function.EC2_REGIONS = args.regions.split(",")
+        lambda_function.load_tenants()
+    lambda_function.EC2_HIBERNATE = args.hibernate
+    lambda_function.RECREATE_MODE = args.recreate_mode
+    lambda_function.RENDER_QR = not args.download_qr
+    lambda_function.RESPOND_IN_WEBHOOK = not args.no_webhook_reply
+    lambda_function.PRE_DISPATCH = not args.no_pre_dispatch
+    lambda_function.SSH_PORT = start_ssh_server(lambda_function.PEERS_DIR)
+    install_telegram_transport(lambda_function.application.bot)
+    persistence = lambda_function.application.persistence
+    if persistence is not None:
+        FakeDynamoDB(lambda_function.get_dynamodb_client()).activate()
+        if os.path.exists(lambda_function.PERSISTENCE_FILE):
+            os.remove(lambda_function.PERSISTENCE_FILE)
+    for client in (lambda_function.ec2_client, lambda_function.ec2_resource.meta.client):
+        FakeEC2(client).activate()
+    for region in (args.regions or "").split(",") if args.regions else []:
+        # Stub every region's cached clients before the bot creates them on first use
+        client, resource = lambda_function.get_ec2(region)
+        if client is not lambda_function.ec2_client:
+            FakeEC2(client).activate()
+            FakeEC2(resource.meta.client).activate()
+    FakeEC2.multi_region = bool(args.regions)
+    os.environ["MONITOR_SECRET"] = "bench"
+    for sample in args.region_rtt:
+        region, rtt = sample.split("=")
+        lambda_function.lambda_handler(monitor_event({"monitor_event": "latency", "rtt_ms": float(rtt), "region": region}), FakeContext())
+
+    # Unique per run: the bot drops update_ids it has already seen
+    update_id = int(time.time() * 1000)
+    print(f"{'action':<16}{'p50 ms':>9}{'p95 ms':>9}  outbound calls per invocation")
+    for action in args.actions:
+        samples, totals = [], Counter()
+        for _ in range(args.iterations):
+            FakeEC2.instance["state"] = INITIAL_STATE.get(action, "running")
+            make_peers(lambda_function.PEERS_DIR)
+            if action in INLINE_ACTIONS:
+                lambda_function.lambda_handler(webhook_event(update_id, "Get Peer Files"), FakeContext())
+                update_id += 1
+                if args.fleet:
+                    # The fleet's keyboard lists instances first
+                    lambda_function.lambda_handler(callback_event(update_id, "bench-01"), FakeContext())
+                    update_id += 1
+                if args.cold_press and persistence is not None:
+                    # Another container: no keyboards in memory, no local copy of the table
+                    lambda_function.application.bot.callback_data_cache.clear_callback_data()
+                    lambda_function.application.bot.callback_data_cache.clear_callback_queries()
+                    persistence.items = None
+                    os.remove(lambda_function.PERSISTENCE_FILE)
+                event = callback_event(update_id, action)
+            elif action == "Spam":
+                event = webhook_event(update_id, "Start EC2", SPAM_CHAT_ID)
+            else:
+                event = webhook_event(update_id, action)
+            rate_limiter = lambda_function.application.bot.rate_limiter
+            if rate_limiter is not None:
+                # Presses seconds apart, not back to back: every chat bucket starts full
+                rate_limiter.chat_limiters.clear()
+            calls.clear()
+            started = time.perf_counter()
+            response = lambda_function.lambda_handler(event, FakeContext())
+            samples.append((time.perf_counter() - started) * 1000)
+            if response.get("headers", {}).get("Content-Type") == "application/json":
+                count(f"webhook:{json.loads(response['body'])['method']}")
+            totals.update(calls)
+            update_id += 1
+        per_call = ", ".join(f"{name}={value / args.iterations:g}" for name, value in sorted(totals.items()))
+        print(f"{action:<16}{percentile(samples, 50):>9.1f}{percentile(samples, 95):>9.1f}  {per_call}")
+
+    # Flood: unauthorized traffic, one invocation after another on a warm container
+    if args.flood:
+        calls.clear()
+        started = time.perf_counter()
+        for _ in range(args.flood):
+            lambda_function.lambda_handler(webhook_event(update_id, "Start EC2", SPAM_CHAT_ID), FakeContext())
+            update_id += 1
+        elapsed = time.perf_counter() - started
+        per_call = ", ".join(f"{name}={value / args.flood:g}" for name, value in sorted(calls.items()))
+        print(f"flood: {args.flood} updates in {elapsed:.2f} s, {args.flood / elapsed:.0f} updates/s, {elapsed / args.flood * 1000:.2f} ms each  {per_call}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,42 @@
 import json
 import telegram
 import requests
+import httpx
 import paramiko
+import nacl.bindings
 import boto3
 import os
 import base64
 from io import BytesIO
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes
+from botocore.config import Config
+from botocore.exceptions import ClientError, WaiterError
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, InvalidCallbackData, BasePersistence, AIORateLimiter
 from telegram.ext.filters import Text
+from telegram.request import HTTPXRequest
+from telegram.error import TimedOut, NetworkError, RetryAfter
+from telegram._utils.defaultvalue import DefaultValue
+from aiolimiter import AsyncLimiter
+from qr_png import qr_png
 import asyncio
 import traceback
+import hmac
+import time
+import functools
+import jmespath
+import uuid
+import threading
+import socket
+import tarfile
+import logging
+import cProfile
+import pstats
+import tracemalloc
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+from contextlib import contextmanager, suppress
 
 # Version: v0.8
 # Changes:
@@ -25,38 +51,1308 @@ SSH_USER = "ubuntu"  # SSH user for EC2 instance (adjust if needed)
 PEERS_DIR = "/home/ubuntu/wireguard/wireguard"  # Directory for WireGuard peers (adjust if needed)
 DOCKER_COMPOSE_DIR = "/home/ubuntu/wireguard"  # Directory for docker-compose.yml (adjust if needed)
 LOG_FILE = "/tmp/bot_log.txt"  # Log file path in Lambda
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # DEBUG also logs raw webhook events and update bodies
+LOG_MAX_BYTES = 1024 * 1024  # Rotate the log file at this size
+LOG_BACKUPS = 1  # Rotated log files kept, so /tmp holds at most (1 + LOG_BACKUPS) * LOG_MAX_BYTES
+LOG_BUFFER_RECORDS = 1000  # Records buffered in memory before an early flush
 EC2_REGION = "eu-west-2"  # AWS region for EC2
+EC2_REGIONS = [EC2_REGION]  # Regions searched for the instance, concurrently; Start EC2 picks the one with the lowest peer RTT
+REGION_RTT_SAMPLES = 20  # Peer RTT samples kept per region (reported by check_wg.py, kept in bot_data)
 EC2_TAG_KEY = "Name"  # EC2 tag key to identify the instance
 EC2_TAG_VALUE = "your-ec2-tag-value"  # Example EC2 tag value (replace with your instance's tag)
+EC2_HIBERNATE = False  # Hibernate instead of stop when the instance supports it (much faster resume)
+HIBERNATE_KEEP_PEERS = True  # Keep peer profiles across hibernation (skips the pre-stop deletion)
+STATUS_CACHE_FILE = "/tmp/bot_status.json"  # Last lifecycle event pushed by check_wg.py
+STATUS_CACHE_TTL = 3600  # Seconds a pushed lifecycle event is kept (start-to-ready breakdown)
+STATUS_ANSWER_TTL = 120  # Seconds a pushed shutdown status answers "Check Status" without polling
+TIMINGS_FILE = "/tmp/bot_timings.json"  # Span durations kept across warm invocations
+TIMINGS_SAMPLES = 200  # Most recent samples kept per span
+TRACE_CALLS = os.getenv("TRACE_CALLS") == "1"  # Opt-in: one JSON record of all outbound calls per invocation
+DEADLINE_MARGIN = 3  # Seconds kept in reserve to report a hand-off before Lambda times out
+EC2_CONNECT_TIMEOUT = 3  # Seconds (botocore connect timeout)
+EC2_READ_TIMEOUT = 10  # Seconds (botocore read timeout)
+EC2_MAX_ATTEMPTS = 4  # Attempts per EC2 call with adaptive retries
+EC2_WAITER_DELAY = 5  # Seconds between polls while waiting for "running"
+SSH_CONNECT_TIMEOUT = 10  # Seconds for TCP connect, SSH banner and auth (each)
+SSH_COMMAND_TIMEOUT = 120  # Seconds a remote command may run, capped by the invocation deadline
+RECREATE_MODE = "wireguard"  # "wireguard": restart only the WireGuard container, "stack": docker-compose down/up, "native": new keys applied live
+PEER_COUNT = 7  # Peers served by the bot (PEERS in docker-compose.yml)
+PAYLOAD_CACHE = True  # Serialize static reply markup once and reuse url-encoded form fields of Bot API requests
+PAYLOAD_CACHE_SIZE = 256  # Encoded form fields kept per container
+PRE_DISPATCH = True  # Route on the raw webhook JSON: denied chats, unknown texts and unhandled update kinds never build an Update
+RESPOND_IN_WEBHOOK = True  # Send the last reply of simple updates as the webhook HTTP response (no sendMessage call)
+CALLBACK_CACHE_SIZE = 64  # Inline keyboards remembered (persisted as one item, well under DynamoDB's 400 KB)
+FLOOD_CONTROL = True  # Pace Bot API requests under Telegram's limits and retry RetryAfter
+RATE_LIMIT_OVERALL = 30  # Bot API requests per second across all chats
+RATE_LIMIT_CHAT = 20  # Burst of messages to one private chat, refilled at one per second
+RATE_LIMIT_GROUP = 20  # Messages per minute to one group chat
+RATE_LIMIT_RETRIES = 2  # Retries of a request answered with RetryAfter, while the deadline allows
+UPLOAD_WORKERS = 3  # Documents uploaded in parallel
+UPLOAD_ATTEMPTS = 3  # Attempts per document before it is reported as not sent
+FLEET_MODE = False  # The tag selects a fleet: Start, Stop and Check Status act on every matching instance
+FLEET_WORKERS = 8  # Instances worked on over SSH in parallel in fleet mode
+FLEET_PAGE_SIZE = 1000  # Instances per describe_instances page when resolving a fleet (the API maximum)
+FLEET_BUTTONS_PER_ROW = 2  # Instance buttons per row of the fleet's "Get Peer Files" inline keyboard
+PEER_BUTTONS_PER_ROW = 4  # Peer buttons per row of the "Get Peer Files" inline keyboard
+RENDER_QR = True  # Render peer QR codes from peerN.conf in the bot instead of downloading peerN.png
+WG_INTERFACE = "wg0"  # WireGuard interface inside the container
+WG_SUBNET = "10.13.13."  # INTERNAL_SUBNET of the container: the server is .1, peerN is .N+1
+PEER_DNS = "172.20.0.2"  # DNS for the peers (PEERDNS in docker-compose.yml, Pi-hole)
+WG_CONFIG_DIR = "/config"  # PEERS_DIR as mounted inside the wireguard container
+WG_SERVER_CONF = "/config/wg_confs/wg0.conf"  # Server config the container loads on start
+PEERS_UPLOAD = "/tmp/wg_peers.tar"  # Upload path on the instance for new peer files
+CLEANUP_TIMEOUT = 10  # Seconds to wait for the pre-stop peer deletion to exit
+SSH_PORT = 22  # sshd port on the instance
+SSH_POOL_MAX_AGE = 120  # Seconds a warm SSH connection is reused by the next command
+READY_BACKOFF_INITIAL = 0.5  # Seconds before the second SSH probe after "running" (doubles each retry)
+READY_BACKOFF_MAX = 4  # Max seconds between SSH probes
+READY_POLL_INTERVAL = 2  # Seconds between container checks once SSH is up
+READY_CONTAINERS = ("wireguard", "pihole")  # Containers that must be running (and healthy) for "WireGuard ready"
+DEDUP_FILE = "/tmp/bot_seen_updates.json"  # update_ids already processed by this container
+DEDUP_TTL = 3600  # Seconds an update_id is remembered (Telegram gives up redelivering well before)
+DEDUP_MAX = 1000  # update_ids remembered per container
+DEDUP_TABLE = os.getenv("DEDUP_TABLE")  # Optional DynamoDB table shared by all containers (key "update_id", TTL "expires")
+LOCK_TABLE = os.getenv("LOCK_TABLE")  # Optional DynamoDB table for per-instance leases across containers (key "lock_key")
+PERSISTENCE_TABLE = os.getenv("PERSISTENCE_TABLE")  # Optional DynamoDB table for user/chat/bot data and inline keyboards (keys "kind", "id")
+PERSISTENCE_FILE = "/tmp/bot_persistence.json"  # Write-through copy of the persisted data for warm containers
+PERSISTENCE_MAX_AGE = 60  # Seconds the local copy answers reads before the table is scanned again
+PERSISTENCE_BATCH_RETRIES = 3  # BatchWriteItem retries for unprocessed items
+LOCK_POLL_INTERVAL = 1  # Seconds between checks while another invocation holds the lease
+LOCK_RESULT_TTL = 120  # Seconds a released lease keeps its result for followers
+PROFILE_INVOCATIONS = int(os.getenv("PROFILE_INVOCATIONS", "0"))  # Profile the first N invocations of each container
+PROFILE_DIR = "/tmp/bot_profiles"  # pstats files and tracemalloc snapshots
+PROFILE_KEEP = 5  # Profiled invocations kept in PROFILE_DIR
+PROFILE_TOP = 10  # Functions / allocation sites listed by /profile
+TENANTS_FILE = os.getenv("TENANTS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tenants.json"))  # Optional: chats served, each with its own instance (without it: ALLOWED_CHAT_ID and the constants above)
+DEFAULT_TENANT = "default"  # Tenant name when TENANTS_FILE does not exist
 
-# Initialize boto3 clients for EC2
-ec2_client = boto3.client("ec2", region_name=EC2_REGION)
-ec2_resource = boto3.resource("ec2", region_name=EC2_REGION)
+# Initialize boto3 clients for EC2 (bounded timeouts, adaptive retries)
+ec2_config = Config(
+    connect_timeout=EC2_CONNECT_TIMEOUT,
+    read_timeout=EC2_READ_TIMEOUT,
+    retries={"mode": "adaptive", "max_attempts": EC2_MAX_ATTEMPTS}
+)
+ec2_client = boto3.client("ec2", region_name=EC2_REGION, config=ec2_config)
+ec2_resource = boto3.resource("ec2", region_name=EC2_REGION, config=ec2_config)
+
+# Logging to /tmp: leveled, buffered in memory and written once per invocation
+# as JSON lines; messages use %-style args, so they are only rendered when written
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+logger = logging.getLogger("bot")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+log_file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True)
+log_file_handler.setFormatter(JsonLogFormatter())
+log_buffer = MemoryHandler(LOG_BUFFER_RECORDS, flushLevel=logging.CRITICAL, target=log_file_handler)
+logger.addHandler(log_buffer)
+
+# Deadline of the current invocation, from context.get_remaining_time_in_millis().
+# DEADLINE_MARGIN is held back so a handler can still tell the user what happened.
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    def __init__(self, remaining_ms):
+        self.expires = time.monotonic() + remaining_ms / 1000 - DEADLINE_MARGIN
+
+    def remaining(self, reserve=True):
+        return max(0.0, self.expires - time.monotonic() + (0 if reserve else DEADLINE_MARGIN))
+
+    # Timeout for one operation: its own cap, cut down to the time left
+    def timeout(self, cap, operation="operation"):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"no time left for {operation}")
+        return min(cap, remaining)
+
+deadline = Deadline(15 * 60 * 1000)  # Replaced at the start of every invocation
+
+# Don't start an EC2 attempt (first or retry) that cannot finish before Lambda times out:
+# an attempt can block for its connect plus read timeout
+def check_ec2_deadline(**kwargs):
+    if deadline.remaining(reserve=False) < EC2_CONNECT_TIMEOUT + EC2_READ_TIMEOUT:
+        raise DeadlineExceeded("no time left for EC2 call")
+
+ec2_client.meta.events.register("before-send.ec2.*", check_ec2_deadline)
+ec2_resource.meta.client.meta.events.register("before-send.ec2.*", check_ec2_deadline)
+
+# SSH connect/banner/auth timeouts bounded by the deadline
+def ssh_timeouts():
+    timeout = deadline.timeout(SSH_CONNECT_TIMEOUT, "SSH connect")
+    return {"timeout": timeout, "banner_timeout": timeout, "auth_timeout": timeout, "channel_timeout": timeout}
+
+# SFTP session bounded by the deadline: channel open, subsystem request, version handshake and reads
+def open_sftp(ssh):
+    timeout = deadline.timeout(SSH_CONNECT_TIMEOUT, "SFTP")
+    with span("sftp_open"):
+        channel = ssh.get_transport().open_session(timeout=timeout)
+        channel.settimeout(timeout)
+        # invoke_subsystem waits for the server's answer without a timeout: closing the channel ends the wait
+        watchdog = threading.Timer(timeout, channel.close)
+        watchdog.start()
+        try:
+            channel.invoke_subsystem("sftp")
+        finally:
+            watchdog.cancel()
+        return paramiko.SFTPClient(channel)
+
+# recv_exit_status() blocks forever: wait on the channel with a deadline instead
+def wait_exit_status(channel, cap=SSH_COMMAND_TIMEOUT):
+    if not channel.status_event.wait(deadline.timeout(cap, "remote command")):
+        raise DeadlineExceeded("remote command still running")
+    return channel.recv_exit_status()
+
+# Timing spans: "<handler>.<operation>" -> most recent durations in ms
+timings = None
+active_handler = "lambda_handler"
+
+def load_timings():
+    global timings
+    if timings is None:
+        timings = {}
+        if os.path.exists(TIMINGS_FILE):
+            try:
+                with open(TIMINGS_FILE, "r") as f:
+                    for name, samples in json.load(f).items():
+                        timings[name] = deque(samples, maxlen=TIMINGS_SAMPLES)
+            except Exception as e:
+                logger.error("error loading timings: %s", e)
+    return timings
+
+def save_timings():
+    if timings is None:
+        return
+    try:
+        with open(TIMINGS_FILE, "w") as f:
+            json.dump({name: list(samples) for name, samples in timings.items()}, f)
+    except Exception as e:
+        logger.error("error saving timings: %s", e)
+
+def record_timing(name, duration_ms):
+    load_timings().setdefault(name, deque(maxlen=TIMINGS_SAMPLES)).append(round(duration_ms, 1))
+
+# Time a block as a span of the handler that is currently running
+@contextmanager
+def span(operation):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(f"{active_handler}.{operation}", (time.perf_counter() - started) * 1000)
+
+# Handler decorator: spans inside are attributed to this handler, plus a total span
+def timed_handler(func):
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        global active_handler
+        previous, active_handler = active_handler, func.__name__
+        try:
+            with span("total"):
+                await func(update, context)
+        finally:
+            active_handler = previous
+    return wrapper
+
+# Profiling: cProfile + tracemalloc for the next N invocations (PROFILE_INVOCATIONS or /profile N).
+# tracemalloc keeps running between profiled invocations, so each memory diff
+# against the previous one shows what a warm container keeps accumulating
+profile_remaining = PROFILE_INVOCATIONS
+profile_run = 0
+profile_baseline = None
+
+def start_profile():
+    global profile_remaining
+    if profile_remaining <= 0:
+        return None
+    profile_remaining -= 1
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def finish_profile(profiler):
+    global profile_run, profile_baseline
+    if profiler is None:
+        return
+    profiler.disable()
+    try:
+        profile_run += 1
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(f"{PROFILE_DIR}/run{profile_run}.pstats")
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*"),
+        ])
+        snapshot.dump(f"{PROFILE_DIR}/run{profile_run}.tracemalloc")
+        old_run = profile_run - PROFILE_KEEP
+        for suffix in ("pstats", "tracemalloc"):
+            if os.path.exists(f"{PROFILE_DIR}/run{old_run}.{suffix}"):
+                os.remove(f"{PROFILE_DIR}/run{old_run}.{suffix}")
+
+        # Summary for /profile: top functions by cumulative time, top allocation sites
+        stats = pstats.Stats(profiler).stats
+        lines = [f"Profile run {profile_run} (top functions by cumulative time):"]
+        top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+        for (file_name, line, function), (cc, calls, total_time, cumulative_time, callers) in top:
+            lines.append(f"{cumulative_time * 1000:.0f} ms {function} ({os.path.basename(file_name)}:{line}, {calls} calls)")
+        if profile_baseline is None:
+            lines.append("Largest allocation sites (live memory):")
+            top_allocations = snapshot.statistics("lineno")[:PROFILE_TOP]
+        else:
+            lines.append("Largest allocation growth since the previous profiled run:")
+            top_allocations = snapshot.compare_to(profile_baseline, "lineno")[:PROFILE_TOP]
+        for stat in top_allocations:
+            frame = stat.traceback[0]
+            growth = getattr(stat, "size_diff", stat.size)
+            lines.append(f"{growth / 1024:+.1f} KiB {os.path.basename(frame.filename)}:{frame.lineno}")
+        profile_baseline = snapshot
+        with open(f"{PROFILE_DIR}/summary.txt", "w") as f:
+            f.write("\n".join(lines))
+    except Exception as e:
+        logger.error("error saving profile: %s", e)
+    if profile_remaining <= 0:
+        tracemalloc.stop()
+        profile_baseline = None
+
+# Outbound call trace for the current invocation (only when TRACE_CALLS is on)
+trace = None
+trace_local = threading.local()
+
+def start_trace(context):
+    global trace
+    if TRACE_CALLS:
+        trace = {
+            "type": "outbound_calls",
+            "request_id": getattr(context, "aws_request_id", None),
+            "started": time.perf_counter(),
+            "ec2": [],
+            "telegram": [],
+            "ssh": [],
+        }
+
+# Print the trace as one JSON line (picked up by CloudWatch Logs Insights)
+def emit_trace():
+    global trace
+    if trace is None:
+        return
+    trace["duration_ms"] = round((time.perf_counter() - trace.pop("started")) * 1000, 1)
+    print(json.dumps(trace))
+    trace = None
+
+# botocore event hooks: per call duration, every attempt (retries included) and its outcome
+def trace_ec2_before_parameter_build(context, **kwargs):
+    if trace is not None:
+        context["trace_started"] = time.perf_counter()
+        context["trace_attempts"] = []
+
+def trace_ec2_before_send(request, **kwargs):
+    trace_local.sent = time.perf_counter()
+
+def trace_ec2_needs_retry(request_dict, response=None, caught_exception=None, **kwargs):
+    attempts = request_dict["context"].get("trace_attempts")
+    if attempts is not None:
+        attempts.append({
+            "ms": round((time.perf_counter() - getattr(trace_local, "sent", time.perf_counter())) * 1000, 1),
+            "status": response[0].status_code if response else None,
+            "error": type(caught_exception).__name__ if caught_exception else None,
+        })
+
+def trace_ec2_after_call(model, context, http_response=None, parsed=None, exception=None, **kwargs):
+    if trace is None or "trace_started" not in context:
+        return
+    trace["ec2"].append({
+        "operation": model.name if model else None,
+        "ms": round((time.perf_counter() - context["trace_started"]) * 1000, 1),
+        "status": http_response.status_code if http_response is not None else None,
+        "retries": (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0),
+        "attempts": context["trace_attempts"],
+        "error": type(exception).__name__ if exception else None,
+    })
+
+def trace_ec2_after_call_error(context, exception, **kwargs):
+    trace_ec2_after_call(None, context, exception=exception)
+
+def register_ec2_tracing(client):
+    events = client.meta.events
+    events.register("before-parameter-build.ec2.*", trace_ec2_before_parameter_build)
+    events.register("before-send.ec2.*", trace_ec2_before_send)
+    events.register("needs-retry.ec2.*", trace_ec2_needs_retry)
+    events.register("after-call.ec2.*", trace_ec2_after_call)
+    events.register("after-call-error.ec2.*", trace_ec2_after_call_error)
+
+if TRACE_CALLS:
+    register_ec2_tracing(ec2_client)
+    register_ec2_tracing(ec2_resource.meta.client)
+
+# EC2 client and resource per region, created on first use and kept for the container
+ec2_regions = {EC2_REGION: (ec2_client, ec2_resource)}
+
+def get_ec2(region):
+    clients = ec2_regions.get(region)
+    if clients is None:
+        client = boto3.client("ec2", region_name=region, config=ec2_config)
+        resource = boto3.resource("ec2", region_name=region, config=ec2_config)
+        for events in (client.meta.events, resource.meta.client.meta.events):
+            events.register("before-send.ec2.*", check_ec2_deadline)
+        if TRACE_CALLS:
+            register_ec2_tracing(client)
+            register_ec2_tracing(resource.meta.client)
+        clients = ec2_regions[region] = (client, resource)
+    return clients
+
+# Tenants: each chat is routed to the instance and peers of its tenant. The index is built
+# once per container, so authorization and routing are one dict lookup per update.
+# Tenant fields default to the constants above; each tenant keeps its own status cache
+class Tenant:
+    def __init__(self, name, chat_ids, tag_key=EC2_TAG_KEY, tag_value=EC2_TAG_VALUE, instance_id=None, region=EC2_REGION,
+                 regions=None, peers_dir=PEERS_DIR, docker_compose_dir=DOCKER_COMPOSE_DIR, ssh_user=SSH_USER, peers=None, notify_chat_id=None,
+                 fleet=None):
+        self.name = name
+        # Telegram sends chat ids as integers, config files and environment variables often as strings
+        self.chat_ids = [int(chat_id) for chat_id in chat_ids]
+        self.tag_key = tag_key
+        self.tag_value = tag_value
+        self.instance_id = instance_id
+        # A fleet is selected by tag, an instance_id is always a single instance
+        self.fleet = (FLEET_MODE if fleet is None else fleet) and not instance_id
+        # An instance id lives in one region; a tag can match an instance in each of several
+        self.regions = [region] if instance_id or not regions else list(regions)
+        self.region = self.regions[0]
+        self.peers_dir = peers_dir
+        self.docker_compose_dir = docker_compose_dir
+        self.ssh_user = ssh_user
+        # Peer numbers this tenant sees, for tenants sharing an instance
+        self.peers = sorted(peers) if peers else list(range(1, PEER_COUNT + 1))
+        self.owns_all_peers = self.peers == list(range(1, PEER_COUNT + 1))
+        # Lifecycle events from check_wg.py go to this chat
+        self.notify_chat_id = int(notify_chat_id) if notify_chat_id is not None else next(iter(self.chat_ids), None)
+        # Single-flight key: tenants sharing an instance share its lease
+        self.instance_key = f"{region}/{instance_id}" if instance_id else f"{'+'.join(self.regions)}/{tag_key}={tag_value}"
+        self.status_file = STATUS_CACHE_FILE if name == DEFAULT_TENANT else STATUS_CACHE_FILE.replace(".json", f"_{name}.json")
+        self.status = None
+
+    @property
+    def ec2_client(self):
+        return get_ec2(self.region)[0]
+
+    @property
+    def ec2_resource(self):
+        return get_ec2(self.region)[1]
+
+    # describe_instances arguments for this tenant's instance, in one of the given states
+    def instance_query(self, *states):
+        filters = [{"Name": "instance-state-name", "Values": list(states)}] if states else []
+        if self.instance_id:
+            return {"InstanceIds": [self.instance_id], "Filters": filters}
+        return {"Filters": [{"Name": f"tag:{self.tag_key}", "Values": [self.tag_value]}] + filters}
+
+tenants_by_chat = {}
+tenants_by_name = {}
+tenant = None  # Tenant of the current update, set at the start of every invocation
+
+def load_tenants():
+    global tenants_by_chat, tenants_by_name
+    if os.path.exists(TENANTS_FILE):
+        with open(TENANTS_FILE, "r") as f:
+            tenants = [Tenant(**config) for config in json.load(f)]
+    else:
+        chat_ids = []
+        with suppress(ValueError):
+            chat_ids.append(int(ALLOWED_CHAT_ID))
+        tenants = [Tenant(DEFAULT_TENANT, chat_ids, regions=EC2_REGIONS)]
+    tenants_by_name = {entry.name: entry for entry in tenants}
+    tenants_by_chat = {}
+    for entry in tenants:
+        for chat_id in entry.chat_ids:
+            if chat_id in tenants_by_chat:
+                logger.warning("chat %s is listed for tenants %s and %s, using %s", chat_id, tenants_by_chat[chat_id].name, entry.name, entry.name)
+            tenants_by_chat[chat_id] = entry
+    logger.info("serving %d chats for %d tenants", len(tenants_by_chat), len(tenants_by_name))
+
+load_tenants()
+
+# Payload cache: url-encoded "name=value" form fields of Bot API requests, so the
+# main keyboard and fixed texts are encoded once per container instead of per send.
+# Strings and ints (chat ids) are keyed by value, dicts by identity (a
+# StaticReplyKeyboardMarkup returns the same one each time)
+encoded_fields = OrderedDict()
+
+def encode_field(name, value):
+    by_value = type(value) in (str, int)
+    key = (name, type(value), value) if by_value else (name, id(value))
+    cached = encoded_fields.get(key)
+    if cached is not None and (by_value or cached[0] is value):
+        encoded_fields.move_to_end(key)
+        return cached[1]
+    # Same encoding as RequestParameter.json_value + urlencode
+    field = f"{quote_plus(name)}={quote_plus(value if isinstance(value, str) else json.dumps(value))}"
+    encoded_fields[key] = (value, field)
+    if len(encoded_fields) > PAYLOAD_CACHE_SIZE:
+        encoded_fields.popitem(last=False)
+    return field
+
+# Bot API requests timed as "<handler>.telegram_<method>" spans (and traced when enabled)
+# Timeouts are cut down to the deadline (including the reserve: replies are the hand-off)
+class TimedRequest(HTTPXRequest):
+    async def do_request(
+        self,
+        url,
+        method,
+        request_data=None,
+        read_timeout=HTTPXRequest.DEFAULT_NONE,
+        write_timeout=HTTPXRequest.DEFAULT_NONE,
+        connect_timeout=HTTPXRequest.DEFAULT_NONE,
+        pool_timeout=HTTPXRequest.DEFAULT_NONE,
+    ):
+        endpoint = url.rsplit("/", 1)[-1]
+        # A reply held for the webhook response must not arrive after a later message
+        await flush_webhook_reply()
+        budget = max(deadline.remaining(reserve=False), 0.1)
+        defaults = self._client.timeout
+        timeouts = {}
+        for name, value, default in (
+            ("read_timeout", read_timeout, defaults.read),
+            # Same media default as HTTPXRequest: 20 s to upload files
+            ("write_timeout", write_timeout, 20 if request_data and request_data.contains_files else defaults.write),
+            ("connect_timeout", connect_timeout, defaults.connect),
+            ("pool_timeout", pool_timeout, defaults.pool),
+        ):
+            if isinstance(value, DefaultValue):
+                value = default
+            timeouts[name] = budget if value is None else min(value, budget)
+        started = time.perf_counter()
+        status = None
+        body = None
+        try:
+            with span(f"telegram_{endpoint}"):
+                if PAYLOAD_CACHE and request_data is not None and not request_data.contains_files:
+                    body = "&".join(encode_field(name, value) for name, value in request_data.parameters.items()).encode()
+                    status, payload = await self.post_form(url, method, body, **timeouts)
+                else:
+                    status, payload = await super().do_request(url, method, request_data, **timeouts)
+            return status, payload
+        finally:
+            if trace is not None:
+                request_bytes = 0
+                if body is not None:
+                    request_bytes = len(body)
+                elif request_data:
+                    request_bytes = len(request_data.json_payload)
+                    for part in (request_data.multipart_data or {}).values():
+                        request_bytes += len(part[1])
+                trace["telegram"].append({
+                    "method": endpoint,
+                    "ms": round((time.perf_counter() - started) * 1000, 1),
+                    "status": status,
+                    "request_bytes": request_bytes,
+                    "response_bytes": len(payload) if status is not None else None,
+                })
+
+    # HTTPXRequest.do_request for an already url-encoded body (same timeouts and errors)
+    async def post_form(self, url, method, body, read_timeout, write_timeout, connect_timeout, pool_timeout):
+        if self._client.is_closed:
+            raise RuntimeError("This HTTPXRequest is not initialized!")
+        try:
+            res = await self._client.request(
+                method=method,
+                url=url,
+                headers={"User-Agent": self.USER_AGENT, "Content-Type": "application/x-www-form-urlencoded"},
+                timeout=httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout),
+                content=body,
+            )
+        except httpx.TimeoutException as err:
+            if isinstance(err, httpx.PoolTimeout):
+                raise TimedOut(message="Pool timeout: All connections in the connection pool are occupied. Request was *not* sent to Telegram.") from err
+            raise TimedOut from err
+        except httpx.HTTPError as err:
+            raise NetworkError(f"httpx.{err.__class__.__name__}: {err}") from err
+        return res.status_code, res.content
+
+# SSH client that adds transport packet/byte counters to the trace when closed
+class TracedSSHClient(paramiko.SSHClient):
+    def connect(self, hostname, *args, **kwargs):
+        self.trace_started = time.perf_counter()
+        super().connect(hostname, *args, **kwargs)
+        self.trace_connect_ms = round((time.perf_counter() - self.trace_started) * 1000, 1)
+        self.trace_host = hostname
+
+    def close(self):
+        transport = self.get_transport()
+        if trace is not None and transport is not None and hasattr(self, "trace_connect_ms"):
+            # Packetizer counters are private and restart at each key exchange
+            packetizer = transport.packetizer
+            trace["ssh"].append({
+                "host": self.trace_host,
+                "connect_ms": self.trace_connect_ms,
+                "session_ms": round((time.perf_counter() - self.trace_started) * 1000, 1),
+                "sent_bytes": getattr(packetizer, "_Packetizer__sent_bytes", None),
+                "sent_packets": getattr(packetizer, "_Packetizer__sent_packets", None),
+                "received_bytes": getattr(packetizer, "_Packetizer__received_bytes", None),
+                "received_packets": getattr(packetizer, "_Packetizer__received_packets", None),
+            })
+        super().close()
+
+# Warm SSH connections: start_ec2 leaves its readiness probe connection here for the next command.
+# Keyed by tenant and host, so a connection is only reused by the tenant that opened it
+ssh_pool = {}
+
+def connect_ssh(host, key_file):
+    pooled = ssh_pool.pop((tenant.name, host), None)
+    if pooled is not None:
+        ssh, pooled_at = pooled
+        transport = ssh.get_transport()
+        if transport is not None and transport.is_active() and time.monotonic() - pooled_at < SSH_POOL_MAX_AGE:
+            logger.info("reusing warm SSH connection to %s", host)
+            return ssh
+        ssh.close()
+    ssh = TracedSSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        with span("ssh_connect"):
+            ssh.connect(host, port=SSH_PORT, username=tenant.ssh_user, key_filename=key_file, **ssh_timeouts())
+    except Exception:
+        ssh.close()
+        raise
+    return ssh
+
+def pool_ssh(host, ssh):
+    previous = ssh_pool.get((tenant.name, host))
+    if previous is not None and previous[0] is not ssh:
+        previous[0].close()
+    ssh_pool[(tenant.name, host)] = (ssh, time.monotonic())
+
+# One remote call reports every container: "/name status health" per line (health empty without a health check)
+def ready_check(containers):
+    return "docker inspect -f '{{.Name}} {{.State.Status}} {{if .State.Health}}{{.State.Health.Status}}{{end}}' " + " ".join(containers)
+
+def containers_ready(output, containers=READY_CONTAINERS):
+    states = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            states[fields[0].lstrip("/")] = fields[1:]
+    return all(
+        name in states and states[name][0] == "running" and states[name][1:] in ([], ["healthy"])
+        for name in containers
+    )
+
+# Poll until the containers are running (and healthy); `extra` is a shell check that must pass as well
+def wait_containers(ssh, containers=READY_CONTAINERS, extra=""):
+    command = ready_check(containers) + extra
+    while True:
+        with span("ready_check"):
+            stdin, stdout, stderr = ssh.exec_command(command, timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+            exit_status = wait_exit_status(stdout.channel, SSH_CONNECT_TIMEOUT)
+            output = stdout.read().decode()
+        # docker inspect fails while a container does not exist yet
+        if exit_status == 0 and containers_ready(output, containers):
+            return
+        logger.debug("containers not ready: %s", output.strip())
+        if deadline.remaining() <= READY_POLL_INTERVAL:
+            raise DeadlineExceeded("containers not ready")
+        time.sleep(READY_POLL_INTERVAL)
+
+# Readiness after "running": sshd accepts a connection (TCP probe with backoff, then auth),
+# then the containers are up. Blocking, run in a thread. Returns (ssh ready, WireGuard ready) epochs
+def wait_until_ready(host, key_file):
+    delay = READY_BACKOFF_INITIAL
+    while True:
+        try:
+            with span("ssh_probe"):
+                socket.create_connection((host, SSH_PORT), timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "SSH probe")).close()
+            ssh = connect_ssh(host, key_file)
+            break
+        except (OSError, paramiko.SSHException) as e:
+            # sshd (and the authorized key) come up a few seconds after "running"
+            logger.debug("SSH not ready on %s: %s", host, e)
+            if deadline.remaining() <= delay:
+                raise DeadlineExceeded("SSH not ready")
+            time.sleep(delay)
+            delay = min(delay * 2, READY_BACKOFF_MAX)
+    ssh_ready = time.time()
+    try:
+        wait_containers(ssh)
+    except Exception:
+        ssh.close()
+        raise
+    # Keep the connection warm for the next command
+    pool_ssh(host, ssh)
+    return ssh_ready, time.time()
+
+# Native peer management: keys are generated here, profiles pushed over SFTP and applied
+# live with `wg set`, so adding or rotating a peer needs no container restart
+def generate_keypair():
+    private_key = bytearray(nacl.bindings.randombytes(nacl.bindings.crypto_scalarmult_SCALARBYTES))
+    # Curve25519 clamping, as `wg genkey` does
+    private_key[0] &= 248
+    private_key[31] = (private_key[31] & 127) | 64
+    public_key = nacl.bindings.crypto_scalarmult_base(bytes(private_key))
+    return base64.b64encode(bytes(private_key)).decode(), base64.b64encode(public_key).decode()
+
+def generate_preshared_key():
+    return base64.b64encode(nacl.bindings.randombytes(32)).decode()
+
+def render_peer_conf(number, private_key, preshared_key, server_public_key, endpoint):
+    return (
+        f"[Interface]\n"
+        f"Address = {WG_SUBNET}{number + 1}\n"
+        f"PrivateKey = {private_key}\n"
+        f"ListenPort = 51820\n"
+        f"DNS = {PEER_DNS}\n"
+        f"\n"
+        f"[Peer]\n"
+        f"PublicKey = {server_public_key}\n"
+        f"PresharedKey = {preshared_key}\n"
+        f"Endpoint = {endpoint}\n"
+        f"AllowedIPs = 0.0.0.0/0, ::/0\n"
+    )
+
+def run_in_wireguard(ssh, command):
+    stdin, stdout, stderr = ssh.exec_command(f"docker exec wireguard sh -c '{command}'", timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+    if wait_exit_status(stdout.channel, SSH_CONNECT_TIMEOUT) != 0:
+        raise RuntimeError(stderr.read().decode().strip() or f"failed: {command.split()[0]}")
+    return stdout.read().decode()
+
+# Server public key, listen port and {allowed ip: peer public key} from `wg show dump`
+# (the first line also carries the server private key: parsed, never logged)
+def read_wg_dump(ssh):
+    with span("wg_dump"):
+        lines = run_in_wireguard(ssh, f"wg show {WG_INTERFACE} dump").splitlines()
+    interface = lines[0].split("\t")
+    peers = {}
+    for line in lines[1:]:
+        fields = line.split("\t")
+        for allowed_ip in fields[3].split(","):
+            peers[allowed_ip] = fields[0]
+    return interface[1], interface[2], peers
+
+# Generate new keys for the numbered peers, upload all their files as one archive and
+# unpack + swap them into the running interface in one remote call. Returns {number: peerN.conf}
+def apply_peers(ssh, host, numbers):
+    server_public_key, listen_port, current = read_wg_dump(ssh)
+    files = {}
+    confs = {}
+    commands = []
+    for number in numbers:
+        private_key, public_key = generate_keypair()
+        preshared_key = generate_preshared_key()
+        peer_dir = f"peer{number}"
+        address = f"{WG_SUBNET}{number + 1}/32"
+        confs[number] = render_peer_conf(number, private_key, preshared_key, server_public_key, f"{host}:{listen_port}")
+        files[f"{peer_dir}/{peer_dir}.conf"] = confs[number]
+        files[f"{peer_dir}/privatekey-{peer_dir}"] = private_key + "\n"
+        files[f"{peer_dir}/publickey-{peer_dir}"] = public_key + "\n"
+        files[f"{peer_dir}/presharedkey-{peer_dir}"] = preshared_key + "\n"
+        if address in current:
+            commands.append(f"wg set {WG_INTERFACE} peer {current[address]} remove")
+        commands.append(f"wg set {WG_INTERFACE} peer {public_key} preshared-key {WG_CONFIG_DIR}/{peer_dir}/presharedkey-{peer_dir} allowed-ips {address}")
+    # Persist the running peers, so a container restart keeps them
+    commands.append(f"wg-quick save {WG_SERVER_CONF}")
+
+    archive = BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mode = 0o600
+            info.mtime = int(time.time())
+            tar.addfile(info, BytesIO(data.encode()))
+    archive.seek(0)
+    with span("sftp_write"):
+        sftp = open_sftp(ssh)
+        try:
+            sftp.putfo(archive, PEERS_UPLOAD)
+        finally:
+            sftp.close()
+    # The container's QR codes would still show the old keys
+    stale = " ".join(f"peer{number}/peer{number}.png" for number in numbers)
+    command = (
+        f"cd {tenant.peers_dir} && tar -xf {PEERS_UPLOAD} && rm -f {PEERS_UPLOAD} {stale} && "
+        f"docker exec wireguard sh -c '{' && '.join(commands)}'"
+    )
+    with span("wg_apply"):
+        stdin, stdout, stderr = ssh.exec_command(command, timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+        if wait_exit_status(stdout.channel, SSH_CONNECT_TIMEOUT) != 0:
+            raise RuntimeError(f"applying peers failed: {stderr.read().decode().strip()}")
+    logger.info("applied %d peers to %s", len(confs), WG_INTERFACE)
+    return confs
 
 # Initialize the Telegram bot
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+# Persistence for user/chat/bot data and the inline keyboard cache (PERSISTENCE_TABLE).
+# Items are {"kind": "user_data" | "chat_data" | "bot_data" | "callback_data" | "conversations",
+# "id": ..., "data": JSON}. Reads are served from memory / PERSISTENCE_FILE while younger than
+# PERSISTENCE_MAX_AGE, else from one Scan. update_* only marks keys whose JSON changed, and
+# flush() (run by application.shutdown) writes them with BatchWriteItem and refreshes the local copy
+class DynamoDBPersistence(BasePersistence):
+    def __init__(self, table):
+        super().__init__()
+        self.table = table
+        self.items = None  # (kind, id) -> JSON as stored
+        self.loaded = 0
+        self.dirty = {}  # (kind, id) -> JSON to put, or None to delete
+
+    def load(self):
+        if self.items is not None and time.time() - self.loaded < PERSISTENCE_MAX_AGE:
+            return self.items
+        if self.items is None and os.path.exists(PERSISTENCE_FILE):
+            try:
+                with open(PERSISTENCE_FILE, "r") as f:
+                    saved = json.load(f)
+                if time.time() - saved["loaded"] < PERSISTENCE_MAX_AGE:
+                    self.items = {(kind, key): data for kind, key, data in saved["items"]}
+                    self.loaded = saved["loaded"]
+                    return self.items
+            except Exception as e:
+                logger.error("error loading persistence cache: %s", e)
+        items = {}
+        try:
+            with span("persistence_scan"):
+                paginator = get_dynamodb_client().get_paginator("scan")
+                for page in paginator.paginate(TableName=self.table, ConsistentRead=True):
+                    for item in page["Items"]:
+                        items[(item["kind"]["S"], item["id"]["S"])] = item["data"]["S"]
+        except Exception as e:
+            # Fail open: start from what this container has
+            logger.error("error scanning %s: %s", self.table, e)
+            items = dict(self.items or {})
+        # Changes not flushed yet win over the table
+        for key, data in self.dirty.items():
+            if data is None:
+                items.pop(key, None)
+            else:
+                items[key] = data
+        self.items, self.loaded = items, time.time()
+        self.save_local()
+        return self.items
 
-# Logging function to /tmp
-def log(message):
+    def save_local(self):
+        try:
+            with open(PERSISTENCE_FILE, "w") as f:
+                json.dump({"loaded": self.loaded, "items": [[kind, key, data] for (kind, key), data in self.items.items()]}, f)
+        except Exception as e:
+            logger.error("error saving persistence cache: %s", e)
+
+    def get(self, kind, key, default):
+        data = self.load().get((kind, key))
+        return default if data is None else json.loads(data)
+
+    def get_all(self, kind):
+        return {int(key): json.loads(data) for (item_kind, key), data in self.load().items() if item_kind == kind}
+
+    def mark(self, kind, key, value):
+        try:
+            data = json.dumps(value, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.error("not persisting %s %s: %s", kind, key, e)
+            return
+        items = self.load()
+        if items.get((kind, key)) != data:
+            items[(kind, key)] = data
+            self.dirty[(kind, key)] = data
+
+    def drop(self, kind, key):
+        if self.load().pop((kind, key), None) is not None:
+            self.dirty[(kind, key)] = None
+
+    async def get_user_data(self):
+        return self.get_all("user_data")
+
+    async def get_chat_data(self):
+        return self.get_all("chat_data")
+
+    async def get_bot_data(self):
+        return self.get("bot_data", "bot", {})
+
+    async def get_callback_data(self):
+        data = self.get("callback_data", "cache", None)
+        return None if data is None else tuple(data)
+
+    async def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in self.get("conversations", name, {}).items()}
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self.get("conversations", name, {})
+        if new_state is None:
+            conversations.pop(json.dumps(list(key)), None)
+        else:
+            conversations[json.dumps(list(key))] = new_state
+        self.mark("conversations", name, conversations)
+
+    async def update_user_data(self, user_id, data):
+        self.mark("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        self.mark("chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        self.mark("bot_data", "bot", data)
+
+    async def update_callback_data(self, data):
+        self.mark("callback_data", "cache", data)
+
+    async def drop_user_data(self, user_id):
+        self.drop("user_data", str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        self.drop("chat_data", str(chat_id))
+
+    # Data is loaded once per invocation by application.initialize, nothing to refresh per update
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        write_requests = []
+        for (kind, key), data in self.dirty.items():
+            item_key = {"kind": {"S": kind}, "id": {"S": key}}
+            if data is None:
+                write_requests.append({"DeleteRequest": {"Key": item_key}})
+            else:
+                write_requests.append({"PutRequest": {"Item": {**item_key, "data": {"S": data}}}})
+        try:
+            with span("persistence_write"):
+                # BatchWriteItem takes 25 requests; unprocessed ones are retried with backoff
+                for i in range(0, len(write_requests), 25):
+                    batch = {self.table: write_requests[i:i + 25]}
+                    for attempt in range(PERSISTENCE_BATCH_RETRIES + 1):
+                        batch = get_dynamodb_client().batch_write_item(RequestItems=batch).get("UnprocessedItems")
+                        if not batch:
+                            break
+                        time.sleep(0.05 * 2 ** attempt)
+                    else:
+                        raise RuntimeError(f"{len(batch[self.table])} items unprocessed")
+            logger.info("persisted %d changed items", len(write_requests))
+            self.dirty = {}
+        except Exception as e:
+            # Kept dirty: the next flush in this container tries again
+            logger.error("error writing %s: %s", self.table, e)
+        self.save_local()
+
+# Flood control: AIORateLimiter's overall and per-group buckets, plus a bucket per private
+# chat (Telegram takes short bursts, then about one message per second). A RetryAfter pauses
+# all requests for the time Telegram asks, and is retried while the invocation deadline allows.
+# The buckets live as long as the container, across invocations
+class FloodControl(AIORateLimiter):
+    def __init__(self):
+        super().__init__(
+            overall_max_rate=RATE_LIMIT_OVERALL,
+            overall_time_period=1,
+            group_max_rate=RATE_LIMIT_GROUP,
+            group_time_period=60
+        )
+        self.chat_limiters = {}
+        self.paused_until = 0
+
+    def chat_limiter(self, chat_id):
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            if len(self.chat_limiters) > 512:
+                # Forget chats whose bucket has fully refilled
+                self.chat_limiters = {key: value for key, value in self.chat_limiters.items() if not value.has_capacity(value.max_rate)}
+            limiter = self.chat_limiters[chat_id] = AsyncLimiter(RATE_LIMIT_CHAT, RATE_LIMIT_CHAT)
+        return limiter
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        with suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            try:
+                if isinstance(chat_id, int) and chat_id > 0:
+                    async with self.chat_limiter(chat_id):
+                        return await super().process_request(callback, args, kwargs, endpoint, data, 0)
+                return await super().process_request(callback, args, kwargs, endpoint, data, 0)
+            except RetryAfter as e:
+                wait = e.retry_after + 0.1
+                if attempt == RATE_LIMIT_RETRIES or wait > deadline.remaining():
+                    raise
+                logger.warning("flood control: %s retried after %.1f s", endpoint, wait)
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+
+# PTB logs every RetryAfter it passes on with a traceback; retries are decided and logged above
+logging.getLogger("telegram.ext.AIORateLimiter").setLevel(logging.CRITICAL)
+
+# Inline keyboard buttons carry Python objects (CallbackDataCache), not just 64-byte strings
+builder = (
+    Application.builder()
+    .token(TELEGRAM_TOKEN)
+    .request(TimedRequest(connection_pool_size=8))
+    .arbitrary_callback_data(CALLBACK_CACHE_SIZE)
+)
+if PERSISTENCE_TABLE:
+    builder.persistence(DynamoDBPersistence(PERSISTENCE_TABLE))
+if FLOOD_CONTROL:
+    builder.rate_limiter(FloodControl())
+application = builder.build()
+
+# Status cache: last lifecycle event pushed by check_wg.py for the current tenant
+# (memory + /tmp for warm containers)
+def save_status(status):
+    tenant.status = status
+    try:
+        with open(tenant.status_file, "w") as f:
+            json.dump(status, f)
+    except Exception as e:
+        logger.error("error saving status cache: %s", e)
+
+def load_status():
+    if tenant.status is None and os.path.exists(tenant.status_file):
+        try:
+            with open(tenant.status_file, "r") as f:
+                tenant.status = json.load(f)
+        except Exception as e:
+            logger.error("error loading status cache: %s", e)
+    if tenant.status and time.time() - tenant.status.get("received", 0) > STATUS_CACHE_TTL:
+        clear_status()
+    return tenant.status
+
+def clear_status():
+    tenant.status = None
+    try:
+        os.remove(tenant.status_file)
+    except FileNotFoundError:
+        pass
+
+# Drop the idle-shutdown status of every tenant of an instance (status helpers act on the current tenant)
+def clear_shutdown_status(instance_key):
+    global tenant
+    current = tenant
+    try:
+        for entry in tenants_by_name.values():
+            if entry.instance_key != instance_key:
+                continue
+            tenant = entry
+            status = load_status()
+            if status and status["event"] in ("peers_deleted", "shutting_down"):
+                clear_status()
+    finally:
+        tenant = current
+
+# Update dedupe: Telegram redelivers an update when the webhook is slow to answer.
+# Seen update_ids live in memory (+ /tmp for warm containers); with DEDUP_TABLE a
+# DynamoDB conditional put also catches redeliveries landing on another container.
+seen_updates = None
+dynamodb_client = None
+
+def load_seen_updates():
+    global seen_updates
+    if seen_updates is None:
+        seen_updates = OrderedDict()
+        if os.path.exists(DEDUP_FILE):
+            try:
+                with open(DEDUP_FILE, "r") as f:
+                    for update_id, expires in json.load(f):
+                        seen_updates[update_id] = expires
+            except Exception as e:
+                logger.error("error loading seen updates: %s", e)
+    now = time.time()
+    while seen_updates and (len(seen_updates) > DEDUP_MAX or next(iter(seen_updates.values())) < now):
+        seen_updates.popitem(last=False)
+    return seen_updates
+
+def get_dynamodb_client():
+    global dynamodb_client
+    if dynamodb_client is None:
+        dynamodb_client = boto3.client("dynamodb", region_name=EC2_REGION, config=ec2_config)
+    return dynamodb_client
+
+def claim_update_in_table(update_id, expires):
+    dynamodb_client = get_dynamodb_client()
     try:
-        with open(LOG_FILE, "a") as f:
-            f.write(f"{message}\n")
+        dynamodb_client.put_item(
+            TableName=DEDUP_TABLE,
+            Item={"update_id": {"N": str(update_id)}, "expires": {"N": str(int(expires))}},
+            ConditionExpression="attribute_not_exists(update_id) OR expires < :now",
+            ExpressionAttributeValues={":now": {"N": str(int(time.time()))}}
+        )
+        return True
+    except dynamodb_client.exceptions.ConditionalCheckFailedException:
+        return False
     except Exception as e:
-        print(f"error logging: {str(e)}")
+        # Fail open: a lost dedupe is better than a lost update
+        logger.error("error claiming update %s in %s: %s", update_id, DEDUP_TABLE, e)
+        return True
+
+# True the first time an update_id is seen, False for a redelivery
+def claim_update(update_id):
+    seen = load_seen_updates()
+    if update_id in seen:
+        return False
+    expires = time.time() + DEDUP_TTL
+    if DEDUP_TABLE and not claim_update_in_table(update_id, expires):
+        return False
+    seen[update_id] = expires
+    save_seen_updates(seen)
+    return True
+
+def save_seen_updates(seen):
+    try:
+        with open(DEDUP_FILE, "w") as f:
+            json.dump(list(seen.items()), f)
+    except Exception as e:
+        logger.error("error saving seen updates: %s", e)
+
+# Undo claim_update for an update that failed, so Telegram's redelivery is processed
+def release_update(update_id):
+    seen = load_seen_updates()
+    expires = seen.pop(update_id, None)
+    if expires is None:
+        return
+    save_seen_updates(seen)
+    if DEDUP_TABLE:
+        dynamodb_client = get_dynamodb_client()
+        try:
+            # Only our own claim: another container may have re-claimed it since
+            dynamodb_client.delete_item(
+                TableName=DEDUP_TABLE,
+                Key={"update_id": {"N": str(update_id)}},
+                ConditionExpression="expires = :expires",
+                ExpressionAttributeValues={":expires": {"N": str(int(expires))}}
+            )
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            pass
+        except Exception as e:
+            logger.error("error releasing update %s in %s: %s", update_id, DEDUP_TABLE, e)
+
+# Single-flight: one state-changing action per instance at a time. A second press of
+# the same action attaches to the running one and gets its result; a different action
+# waits for it to finish. Process-local first, then a DynamoDB lease (LOCK_TABLE)
+# for invocations running in other containers.
+local_flights = {}
+active_flight = None
+
+class Flight:
+    def __init__(self, key, action):
+        self.key = key
+        self.action = action
+        self.owner = str(uuid.uuid4())
+        self.result = None
+        self.finished = asyncio.Event()
+
+LEASE_NAMES = {"#owner": "owner", "#action": "action", "#state": "state", "#expires": "expires", "#result": "result"}
+
+def acquire_lease(flight):
+    now = int(time.time())
+    try:
+        get_dynamodb_client().put_item(
+            TableName=LOCK_TABLE,
+            Item={
+                "lock_key": {"S": flight.key},
+                "owner": {"S": flight.owner},
+                "action": {"S": flight.action},
+                "state": {"S": "running"},
+                # The lease dies with the invocation that holds it
+                "expires": {"N": str(now + int(deadline.remaining(reserve=False)) + 1)}
+            },
+            ConditionExpression="attribute_not_exists(lock_key) OR #expires < :now OR #state = :done",
+            ExpressionAttributeNames={"#expires": "expires", "#state": "state"},
+            ExpressionAttributeValues={":now": {"N": str(now)}, ":done": {"S": "done"}}
+        )
+        return True
+    except get_dynamodb_client().exceptions.ConditionalCheckFailedException:
+        return False
+
+def read_lease(key):
+    item = get_dynamodb_client().get_item(TableName=LOCK_TABLE, Key={"lock_key": {"S": key}}, ConsistentRead=True).get("Item")
+    if not item or int(item["expires"]["N"]) < time.time():
+        return None
+    return {name: list(value.values())[0] for name, value in item.items()}
+
+def release_lease(flight):
+    try:
+        get_dynamodb_client().update_item(
+            TableName=LOCK_TABLE,
+            Key={"lock_key": {"S": flight.key}},
+            UpdateExpression="SET #state = :done, #result = :result, #expires = :expires",
+            ConditionExpression="#owner = :owner",
+            ExpressionAttributeNames={name: LEASE_NAMES[name] for name in ("#state", "#result", "#expires", "#owner")},
+            ExpressionAttributeValues={
+                ":done": {"S": "done"},
+                ":result": {"S": flight.result or ""},
+                ":expires": {"N": str(int(time.time()) + LOCK_RESULT_TTL)},
+                ":owner": {"S": flight.owner}
+            }
+        )
+    except Exception as e:
+        logger.error("error releasing lease %s: %s", flight.key, e)
+
+# Returns (flight, True) to lead, (finished flight, False) to follow, or (None, False) on deadline
+async def acquire_flight(key, action):
+    followed_owner = None
+    while deadline.remaining() > LOCK_POLL_INTERVAL:
+        running = local_flights.get(key)
+        if running is not None:
+            try:
+                await asyncio.wait_for(running.finished.wait(), deadline.remaining())
+            except asyncio.TimeoutError:
+                return None, False
+            if running.action == action:
+                return running, False
+            continue
+        flight = Flight(key, action)
+        try:
+            # A follower checks for the result first: a released lease is free to take
+            lease = read_lease(key) if followed_owner else None
+            if lease and lease["state"] == "done" and lease["owner"] == followed_owner:
+                flight.result = lease.get("result")
+                return flight, False
+            if not LOCK_TABLE or acquire_lease(flight):
+                local_flights[key] = flight
+                return flight, True
+            lease = read_lease(key)
+        except Exception as e:
+            # Fail open: DynamoDB trouble must not block the bot
+            logger.error("error acquiring lease %s: %s", key, e)
+            local_flights[key] = flight
+            return flight, True
+        if lease and lease["state"] == "running" and lease["action"] == action:
+            followed_owner = lease["owner"]
+        logger.info("lease %s held by %s, waiting", key, lease and lease["action"])
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+    return None, False
+
+def release_flight(flight):
+    if local_flights.get(flight.key) is flight:
+        del local_flights[flight.key]
+    if LOCK_TABLE:
+        release_lease(flight)
+    flight.finished.set()
+
+# Labels for single-flight actions, as shown on the keyboard
+ACTION_LABELS = {
+    "start_ec2": "Start EC2",
+    "stop_ec2": "Stop EC2",
+    "get_files": "Get Peer Files",
+    "send_peer": "Get Peer Files",
+    "pick_node": "Get Peer Files",
+    "recreate_peers": "Recreate Peers",
+    "rotate_peer": "/rotate",
+}
+
+# Handler decorator: run the handler as a single flight on the instance
+def single_flight(func):
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        global active_flight
+        # Chats outside the index have no tenant and so no instance key to lock
+        if not check_access(update):
+            if update.callback_query is not None:
+                await update.callback_query.answer()
+            await respond(update, "Access denied!")
+            return
+        key = f"instance:{tenant.instance_key}"
+        flight, leader = await acquire_flight(key, func.__name__)
+        if flight is None:
+            await respond(update, "Another action is still running on the instance, try again in a minute.", reply_markup=MAIN_KEYBOARD)
+            return
+        if not leader:
+            logger.info("attached to running %s", func.__name__)
+            await respond(update, f"{ACTION_LABELS[func.__name__]} was already in progress:\n{flight.result}", reply_markup=MAIN_KEYBOARD)
+            return
+        active_flight = flight
+        try:
+            await func(update, context)
+        finally:
+            active_flight = None
+            release_flight(flight)
+    return wrapper
+
+# Reply helper: all text replies go through here (the last one is a single flight's result)
+async def reply(update, text, **kwargs):
+    if active_flight is not None:
+        active_flight.result = text
+    return await update.effective_message.reply_text(text, **kwargs)
+
+# Webhook response: Telegram runs a Bot API method returned in the body of the
+# webhook reply, which saves the outbound HTTPS call for the last message of an update.
+# webhook_reply is (payload, send): send() makes the call instead if anything else is sent later
+webhook_open = False
+webhook_reply = None
+
+def hold_webhook_reply(payload, send):
+    global webhook_reply
+    if not RESPOND_IN_WEBHOOK or not webhook_open or webhook_reply is not None:
+        return False
+    webhook_reply = (payload, send)
+    return True
+
+async def flush_webhook_reply():
+    global webhook_reply
+    if webhook_reply is not None:
+        _, send = webhook_reply
+        webhook_reply = None
+        logger.debug("webhook reply superseded, sending it through the Bot API")
+        await send()
+
+def take_webhook_reply():
+    global webhook_open, webhook_reply
+    held, webhook_open, webhook_reply = webhook_reply, False, None
+    return held[0] if held else None
+
+# sendMessage call answering a message, as reply_text would make it
+def message_payload(chat_id, chat_type, message_id, text, reply_markup=None):
+    payload = {"method": "sendMessage", "chat_id": chat_id, "text": text}
+    # reply_text quotes the message outside private chats
+    if chat_type != "private":
+        payload["reply_to_message_id"] = message_id
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_dict()
+    return payload
+
+# Final reply of an update: goes out in the webhook response when possible (returns no Message)
+async def respond(update, text, reply_markup=None):
+    if active_flight is not None:
+        active_flight.result = text
+    chat = update.effective_chat
+    payload = message_payload(chat.id, chat.type, update.effective_message.message_id, text, reply_markup)
+    if not hold_webhook_reply(payload, lambda: update.effective_message.reply_text(text, reply_markup=reply_markup)):
+        await update.effective_message.reply_text(text, reply_markup=reply_markup)
 
 # Access check for Telegram chat
 def check_access(update: Update) -> bool:
-    chat_id = update.effective_chat.id if update.message else None
+    chat_id = update.effective_chat.id if update.effective_message else None
     if chat_id is None:
-        log("failed to determine chat_id")
+        logger.warning("failed to determine chat_id")
         return False
-    log(f"checking chat_id: {chat_id}")
-    if chat_id != ALLOWED_CHAT_ID:
-        return False
-    return True
+    logger.debug("checking chat_id: %s", chat_id)
+    return chat_allowed(chat_id)
+
+def chat_allowed(chat_id):
+    return chat_id in tenants_by_chat
+
+# Reply keyboard that never changes: to_dict() is built once and returned on every send
+class StaticReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    __slots__ = ("_payload",)
+
+    def to_dict(self, recursive=True):
+        if not PAYLOAD_CACHE or not recursive:
+            return super().to_dict(recursive)
+        payload = getattr(self, "_payload", None)
+        if payload is None:
+            payload = self._payload = super().to_dict()
+        return payload
 
 # Create a persistent keyboard menu with buttons
-MAIN_KEYBOARD = ReplyKeyboardMarkup(
+MAIN_KEYBOARD = StaticReplyKeyboardMarkup(
     [
         [KeyboardButton("Start EC2"), KeyboardButton("Stop EC2")],
         [KeyboardButton("Check Status")],
@@ -68,256 +1364,691 @@ MAIN_KEYBOARD = ReplyKeyboardMarkup(
 
 # Command: /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    log("called /start command")
+    logger.info("called /start command")
     if not check_access(update):
-        await update.message.reply_text("Access denied!", reply_markup=MAIN_KEYBOARD)
+        await respond(update, "Access denied!", reply_markup=MAIN_KEYBOARD)
         return
-    await update.message.reply_text(
+    await respond(
+        update,
         "Hello! I am an EC2 bot.\nChoose an action from the menu below:",
         reply_markup=MAIN_KEYBOARD
     )
 
 # Handler for button messages
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    log("received message from button")
+    logger.info("received message from button")
     if not check_access(update):
-        await update.message.reply_text("Access denied!", reply_markup=MAIN_KEYBOARD)
+        await respond(update, "Access denied!", reply_markup=MAIN_KEYBOARD)
         return
     
     message_text = update.message.text
-    log(f"button pressed: {message_text}")
+    logger.info("button pressed: %s", message_text)
     
-    if message_text == "Start EC2":
-        await start_ec2(update, context)
-    elif message_text == "Stop EC2":
-        await stop_ec2(update, context)
-    elif message_text == "Check Status":
-        await get_instance_info(update, context)
-    elif message_text == "Get Peer Files":
-        await get_files(update, context)
-    elif message_text == "Recreate Peers":
-        await recreate_peers(update, context)
-    else:
-        log(f"unknown button: {message_text}")
-        await update.message.reply_text("Unknown action!", reply_markup=MAIN_KEYBOARD)
+    handler = BUTTON_HANDLERS.get(message_text)
+    if handler is None:
+        logger.warning("unknown button: %s", message_text)
+        await respond(update, "Unknown action!", reply_markup=MAIN_KEYBOARD)
+        return
+    await handler(update, context)
+
+# Regions: with several, describe_instances runs in all of them at once (one cached client
+# per region) and the matches are ranked: a running instance first, then the region with the
+# lowest median peer RTT reported by check_wg.py, then the configured order
+def region_rtt(region):
+    samples = application.bot_data.get("region_rtt", {}).get(tenant.name, {}).get(region)
+    return sorted(samples)[len(samples) // 2] if samples else None
+
+def record_region_rtt(region, rtt_ms):
+    samples = application.bot_data.setdefault("region_rtt", {}).setdefault(tenant.name, {}).setdefault(region, [])
+    samples.append(round(rtt_ms, 1))
+    del samples[:-REGION_RTT_SAMPLES]
+
+# [(region, describe_instances response)] for the regions where the instance matches, best first
+async def find_instances(*states):
+    query = tenant.instance_query(*states)
+    if len(tenant.regions) == 1:
+        with span("ec2_describe"):
+            response = get_ec2(tenant.regions[0])[0].describe_instances(**query)
+        return [(tenant.regions[0], response)] if response["Reservations"] else []
+    # Clients are created here: boto3 sessions are not thread-safe, clients are
+    clients = [get_ec2(region)[0] for region in tenant.regions]
+    loop = asyncio.get_running_loop()
+    with span("ec2_describe"):
+        responses = await asyncio.gather(
+            *(loop.run_in_executor(fleet_pool, functools.partial(client.describe_instances, **query)) for client in clients),
+            return_exceptions=True
+        )
+    found = []
+    for region, response in zip(tenant.regions, responses):
+        if isinstance(response, Exception):
+            logger.warning("describe_instances failed in %s: %s", region, response)
+        elif response["Reservations"]:
+            found.append((region, response))
+    if not found and all(isinstance(response, Exception) for response in responses):
+        raise responses[0]
+
+    def rank(item):
+        region, response = item
+        running = any(instance["State"]["Name"] == "running" for reservation in response["Reservations"] for instance in reservation["Instances"])
+        rtt = region_rtt(region)
+        return (not running, rtt is None, rtt or 0, tenant.regions.index(region))
+    return sorted(found, key=rank)
+
+# Public IP of one of the tenant's instances, None unless it is still running. Inline buttons
+# outlive the IP they were made for: after a stop/start it may belong to another host
+def running_instance_ip(region, instance_id):
+    if tenant.instance_id and instance_id != tenant.instance_id:
+        return None
+    query = tenant.instance_query("running")
+    query["InstanceIds"] = [instance_id]
+    try:
+        with span("ec2_describe"):
+            response = get_ec2(region)[0].describe_instances(**query)
+    except ClientError as e:
+        logger.warning("instance %s not found in %s: %s", instance_id, region, e)
+        return None
+    for reservation in response["Reservations"]:
+        for instance in reservation["Instances"]:
+            if instance["InstanceId"] == instance_id:
+                return instance.get("PublicIpAddress")
+    return None
+
+# The best match: (region, response), with no reservations if nothing matched
+async def find_instance(*states):
+    found = await find_instances(*states)
+    return found[0] if found else (tenant.regions[0], {"Reservations": []})
+
+# Fleet mode: the tenant's tag selects many instances. They are resolved with one paginated
+# describe_instances, reduced to the fields the bot uses by a JMESPath projection. Start and
+# stop are one call for all instance ids, and per-instance SSH work runs on a bounded pool
+FLEET_FIELDS = jmespath.compile(
+    "Reservations[].Instances[].{id: InstanceId, state: State.Name, ip: PublicIpAddress, "
+    "name: Tags[?Key=='Name'] | [0].Value, hibernation: HibernationOptions.Configured}"
+)
+# Threads for per-instance SSH work and per-region EC2 calls
+fleet_pool = ThreadPoolExecutor(max_workers=FLEET_WORKERS, thread_name_prefix="fleet")
+
+def describe_fleet(*states):
+    nodes = []
+    with span("ec2_describe"):
+        paginator = tenant.ec2_client.get_paginator("describe_instances")
+        for page in paginator.paginate(**tenant.instance_query(*states), PaginationConfig={"PageSize": FLEET_PAGE_SIZE}):
+            nodes.extend(FLEET_FIELDS.search(page))
+    return sorted(nodes, key=lambda node: (node["name"] or "", node["id"]))
+
+# Run func(node, *args) for every node on the fleet pool; results in node order, errors returned, not raised
+async def fan_out(func, nodes, *args):
+    loop = asyncio.get_running_loop()
+    with span("fleet_fan_out"):
+        return await asyncio.gather(*(loop.run_in_executor(fleet_pool, func, node, *args) for node in nodes), return_exceptions=True)
+
+def node_label(node):
+    return f"{node['name']} ({node['id']})" if node["name"] else node["id"]
+
+# Write the SSH key from the environment to /tmp; None if SSH_KEY is not set
+def write_key_file():
+    ssh_key_b64 = os.getenv("SSH_KEY")
+    if not ssh_key_b64:
+        logger.error("SSH_KEY environment variable not set")
+        return None
+    key_file = "/tmp/wireguard-key.pem"
+    # A copy left by a failed invocation is read-only (0o400)
+    with suppress(FileNotFoundError):
+        os.remove(key_file)
+    with open(key_file, "w") as f:
+        f.write(base64.b64decode(ssh_key_b64).decode("utf-8"))
+    os.chmod(key_file, 0o400)
+    return key_file
+
+# One line of the fleet status: peers and uptime over SSH (blocking, runs on the fleet pool)
+def node_status(node, key_file):
+    ssh = connect_ssh(node["ip"], key_file)
+    try:
+        sftp = open_sftp(ssh)
+        try:
+            with span("sftp_list"):
+                peers = "peers present" if sftp.listdir(tenant.peers_dir) else "peers absent"
+        except FileNotFoundError:
+            peers = "peers absent"
+        finally:
+            sftp.close()
+        with span("ssh_exec"):
+            stdin, stdout, stderr = ssh.exec_command("uptime -p", timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+            uptime = stdout.read().decode().strip()
+    except Exception:
+        ssh.close()
+        raise
+    pool_ssh(node["ip"], ssh)
+    return f"{peers}, {uptime}"
+
+# Delete one node's peers before it stops (blocking, runs on the fleet pool). True if deleted
+def clear_node_peers(node, key_file):
+    ssh = connect_ssh(node["ip"], key_file)
+    with span("ssh_exec"):
+        stdin, stdout, stderr = ssh.exec_command(f"rm -rf {tenant.peers_dir}", timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+    return wait_cleanup(ssh, stdout.channel)
+
+async def start_fleet(update):
+    nodes = describe_fleet("stopped")
+    if not nodes:
+        await reply(update, "No stopped instances in the fleet!", reply_markup=MAIN_KEYBOARD)
+        return
+    ids = [node["id"] for node in nodes]
+    logger.info("starting %d fleet instances", len(ids))
+    started = time.time()
+    with span("ec2_start"):
+        tenant.ec2_client.start_instances(InstanceIds=ids)
+    try:
+        with span("ec2_wait"):
+            # One DescribeInstances per poll for the whole fleet. Polls that could not finish
+            # in time are refused by check_ec2_deadline (DeadlineExceeded: still starting)
+            tenant.ec2_client.get_waiter("instance_running").wait(InstanceIds=ids, WaiterConfig={
+                "Delay": EC2_WAITER_DELAY,
+                "MaxAttempts": max(1, int(deadline.remaining() // EC2_WAITER_DELAY))
+            })
+    except (WaiterError, DeadlineExceeded) as e:
+        logger.warning("fleet not running before the deadline: %s", e)
+        await reply(update, f"{len(ids)} instances are starting!\nNot all are running yet, press Check Status in a minute.", reply_markup=MAIN_KEYBOARD)
+        return
+    running = time.time()
+    nodes = [node for node in describe_fleet("running") if node["id"] in ids]
+    await update.message.reply_text(f"{len(nodes)} instances running after {running - started:.0f} s.\nWaiting for SSH and WireGuard...")
+    key_file = write_key_file()
+    if key_file is None:
+        await reply(update, "\n".join(f"{node_label(node)}: {node['ip']}" for node in nodes), reply_markup=MAIN_KEYBOARD)
+        return
+    try:
+        ready = await fan_out(lambda node: wait_until_ready(node["ip"], key_file) if node["ip"] else None, nodes)
+    finally:
+        os.remove(key_file)
+    lines = []
+    for node, result in zip(nodes, ready):
+        if isinstance(result, tuple):
+            lines.append(f"{node_label(node)}: {node['ip']}, WireGuard ready in {result[1] - started:.0f} s")
+        elif not node["ip"]:
+            lines.append(f"{node_label(node)}: no public IP")
+        else:
+            lines.append(f"{node_label(node)}: {node['ip']}, not ready ({result})")
+    await reply(update, f"Fleet started: {len(nodes)} instances.\n" + "\n".join(lines), reply_markup=MAIN_KEYBOARD)
+
+async def stop_fleet(update):
+    nodes = describe_fleet("running")
+    if not nodes:
+        await reply(update, "No running instances in the fleet!", reply_markup=MAIN_KEYBOARD)
+        return
+    hibernating = {node["id"] for node in nodes if EC2_HIBERNATE and node["hibernation"]}
+    clear = [node for node in nodes if node["ip"] and not (node["id"] in hibernating and HIBERNATE_KEEP_PEERS)]
+    failed = []
+    if clear:
+        key_file = write_key_file()
+        if key_file is None:
+            await reply(update, "Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+            return
+        try:
+            deleted = await fan_out(clear_node_peers, clear, key_file)
+        finally:
+            os.remove(key_file)
+        failed = [node_label(node) for node, result in zip(clear, deleted) if result is not True]
+    # At most two calls: instances that hibernate and instances that stop
+    for hibernate in (True, False):
+        ids = [node["id"] for node in nodes if (node["id"] in hibernating) == hibernate]
+        if ids:
+            logger.info("stopping %d fleet instances (hibernate: %s)", len(ids), hibernate)
+            with span("ec2_stop"):
+                tenant.ec2_client.stop_instances(InstanceIds=ids, Hibernate=hibernate)
+    clear_status()
+    text = f"Fleet stopping: {len(nodes)} instances ({len(hibernating)} hibernating). Peers deleted on {len(clear) - len(failed)}."
+    if failed:
+        text += f"\nPeer deletion did not finish on {', '.join(failed)}, profiles may remain."
+    await reply(update, text, reply_markup=MAIN_KEYBOARD)
+
+async def fleet_status(update):
+    nodes = describe_fleet()
+    if not nodes:
+        await reply(update, "No instances in the fleet!", reply_markup=MAIN_KEYBOARD)
+        return
+    reachable = [node for node in nodes if node["state"] == "running" and node["ip"]]
+    key_file = write_key_file() if reachable else None
+    results = {}
+    if key_file is not None:
+        try:
+            results = dict(zip((node["id"] for node in reachable), await fan_out(node_status, reachable, key_file)))
+        finally:
+            os.remove(key_file)
+    lines = []
+    for node in nodes:
+        line = f"{node_label(node)}: {node['state']}"
+        if node["ip"]:
+            line += f", {node['ip']}"
+        result = results.get(node["id"])
+        if isinstance(result, Exception):
+            line += f", SSH error: {result}"
+        elif result is not None:
+            line += f", {result}"
+        lines.append(line)
+    running = sum(node["state"] == "running" for node in nodes)
+    # Telegram messages are limited to 4096 characters
+    await reply(update, (f"Fleet: {len(nodes)} instances, {running} running\n" + "\n".join(lines))[:4000], reply_markup=MAIN_KEYBOARD)
 
 # Command: Start EC2 instance using boto3 (without EIP, using auto-assigned public IP)
+@timed_handler
+@single_flight
 async def start_ec2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    log("called start_ec2")
+    logger.info("called start_ec2")
     try:
+        if tenant.fleet:
+            await start_fleet(update)
+            return
         # Find the instance by tag
-        response = ec2_client.describe_instances(
-            Filters=[
-                {
-                    "Name": f"tag:{EC2_TAG_KEY}",
-                    "Values": [EC2_TAG_VALUE]
-                },
-                {
-                    "Name": "instance-state-name",
-                    "Values": ["stopped", "stopping"]
-                }
-            ]
-        )
+        if len(tenant.regions) > 1:
+            # The stopped instance in the fastest region, unless one already runs elsewhere
+            running, (region, response) = await asyncio.gather(find_instances("pending", "running"), find_instance("stopped", "stopping"))
+            if running:
+                await reply(update, f"Instance already running in {running[0][0]}!", reply_markup=MAIN_KEYBOARD)
+                return
+        else:
+            region, response = await find_instance("stopped", "stopping")
         instances = response["Reservations"]
         if not instances:
-            await update.message.reply_text("Instance not found or already running!", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance not found or already running!", reply_markup=MAIN_KEYBOARD)
             return
+        where = f"\nRegion: {region}" if len(tenant.regions) > 1 else ""
         
         instance_id = instances[0]["Instances"][0]["InstanceId"]
-        log(f"starting instance: {instance_id}")
-        ec2_client.start_instances(InstanceIds=[instance_id])
+        # Resuming from hibernation restores memory, so WireGuard comes back much sooner than on a cold boot
+        state_reason = instances[0]["Instances"][0].get("StateReason", {}).get("Code", "")
+        mode = "resume" if state_reason == "Client.UserInitiatedHibernate" else "boot"
+        logger.info("starting instance: %s in %s (%s)", instance_id, region, mode)
+        started = time.time()
+        with span("ec2_start"):
+            get_ec2(region)[0].start_instances(InstanceIds=[instance_id])
+        api_call = time.time() - started
+        save_status({"event": "starting", "mode": mode, "started": started, "time": int(started), "received": started})
         
-        # Wait for the instance to start
-        instance = ec2_resource.Instance(instance_id)
-        instance.wait_until_running()
-        instance.reload()
-        log(f"instance {instance_id} started, state: {instance.state['Name']}")
+        # Wait for the instance to start; check_ec2_deadline refuses the polls that could not finish in time
+        instance = get_ec2(region)[1].Instance(instance_id)
+        try:
+            with span("ec2_wait"):
+                instance.wait_until_running(WaiterConfig={
+                    "Delay": EC2_WAITER_DELAY,
+                    "MaxAttempts": max(1, int(deadline.remaining() // EC2_WAITER_DELAY))
+                })
+                instance.reload()
+        except (WaiterError, DeadlineExceeded) as e:
+            logger.warning("instance %s not running before the deadline: %s", instance_id, e)
+            await reply(update, f"Instance {instance_id} is starting!\nIt is not running yet, press Check Status in a minute.", reply_markup=MAIN_KEYBOARD)
+            return
+        running = time.time()
+        record_timing(f"start_ec2.running_{mode}", (running - started) * 1000)
+        logger.info("instance %s started, state: %s", instance_id, instance.state['Name'])
         
         # Get the new public IP (auto-assigned by EC2)
         public_ip = instance.public_ip_address
         if not public_ip:
-            await update.message.reply_text("Instance started, but no public IP assigned! Check Auto-assign Public IP settings.", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance started, but no public IP assigned! Check Auto-assign Public IP settings.", reply_markup=MAIN_KEYBOARD)
+            return
+        
+        logger.info("instance public IP: %s", public_ip)
+        
+        key_file = write_key_file()
+        if key_file is None:
+            # No readiness probes without the key
+            await reply(update, f"Instance {instance_id} started!\nIP: {public_ip}", reply_markup=MAIN_KEYBOARD)
             return
         
-        log(f"instance public IP: {public_ip}")
-        await update.message.reply_text(f"Instance {instance_id} started!\nIP: {public_ip}", reply_markup=MAIN_KEYBOARD)
+        # Probe readiness while the chat already gets the IP
+        try:
+            ready, _ = await asyncio.gather(
+                asyncio.to_thread(wait_until_ready, public_ip, key_file),
+                update.message.reply_text(f"Instance {instance_id} is running!\nIP: {public_ip}{where}\nWaiting for SSH and WireGuard...")
+            )
+        except DeadlineExceeded as e:
+            # check_wg.py posts wireguard_up when it gets there
+            logger.warning("instance %s not ready before the deadline: %s", instance_id, e)
+            await reply(update, f"Instance {instance_id} started!\nIP: {public_ip}\nWireGuard is not ready yet, press Check Status in a minute.", reply_markup=MAIN_KEYBOARD)
+            return
+        finally:
+            os.remove(key_file)
+        ssh_ready, wireguard_ready = ready
+        record_timing(f"start_ec2.ssh_ready_{mode}", (ssh_ready - started) * 1000)
+        record_timing(f"start_ec2.wireguard_ready_{mode}", (wireguard_ready - started) * 1000)
+        save_status({"event": "wireguard_up", "time": int(wireguard_ready), "received": time.time()})
+        await reply(
+            update,
+            f"Instance {instance_id} is ready!\nIP: {public_ip}{where}\n"
+            f"API call: {api_call:.1f} s\n"
+            f"Running: {running - started:.0f} s\n"
+            f"SSH ready: {ssh_ready - started:.0f} s\n"
+            f"WireGuard ready: {wireguard_ready - started:.0f} s",
+            reply_markup=MAIN_KEYBOARD
+        )
     except Exception as e:
-        log(f"error in start_ec2: {str(e)}")
-        await update.message.reply_text(f"Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+        logger.error("error in start_ec2: %s", e)
+        await reply(update, f"Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+# Pre-stop cleanup: wait for the remote rm to exit (True if it succeeded), then hang up
+def wait_cleanup(ssh, channel):
+    try:
+        with span("ssh_wait"):
+            exit_status = wait_exit_status(channel, CLEANUP_TIMEOUT)
+    except DeadlineExceeded as e:
+        logger.warning("peer deletion did not finish: %s", e)
+        exit_status = None
+    finally:
+        ssh.close()
+    return exit_status == 0
 
-# Command: Stop EC2 instance using boto3 (without EIP, with peer deletion and delay)
+# Command: Stop EC2 instance using boto3 (without EIP, with peer deletion)
+@timed_handler
+@single_flight
 async def stop_ec2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    log("called stop_ec2")
+    logger.info("called stop_ec2")
     try:
+        if tenant.fleet:
+            await stop_fleet(update)
+            return
         # Find the instance by tag
-        response = ec2_client.describe_instances(
-            Filters=[
-                {
-                    "Name": f"tag:{EC2_TAG_KEY}",
-                    "Values": [EC2_TAG_VALUE]
-                },
-                {
-                    "Name": "instance-state-name",
-                    "Values": ["running"]
-                }
-            ]
-        )
+        region, response = await find_instance("running")
         instances = response["Reservations"]
         if not instances:
-            await update.message.reply_text("Instance not found or already stopped!", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance not found or already stopped!", reply_markup=MAIN_KEYBOARD)
             return
         
-        instance_id = instances[0]["Instances"][0]["InstanceId"]
-        instance = ec2_resource.Instance(instance_id)
-        ec2_ip = instance.public_ip_address
+        instance = instances[0]["Instances"][0]
+        instance_id = instance["InstanceId"]
+        ec2_ip = instance.get("PublicIpAddress")
+        # Hibernation has to be enabled at launch (encrypted root volume, supported type)
+        hibernate = EC2_HIBERNATE and instance.get("HibernationOptions", {}).get("Configured", False)
+        if EC2_HIBERNATE and not hibernate:
+            logger.warning("instance %s is not configured for hibernation, stopping instead", instance_id)
+        keep_peers = hibernate and HIBERNATE_KEEP_PEERS
         
-        if ec2_ip:
+        if ec2_ip and not keep_peers:
             # Delete the peers folder before shutdown
-            log(f"SSH clear_peers before shutdown, IP: {ec2_ip}")
-            # Load SSH key from environment variable (expected to be Base64-encoded)
-            ssh_key_b64 = os.getenv("SSH_KEY")
-            if not ssh_key_b64:
-                log("SSH_KEY environment variable not set")
-                await update.message.reply_text("Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+            logger.info("SSH clear_peers before shutdown, IP: %s", ec2_ip)
+            key_file = write_key_file()
+            if key_file is None:
+                await reply(update, "Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
                 return
-            ssh_key = base64.b64decode(ssh_key_b64).decode("utf-8")
-            key_file = "/tmp/wireguard-key.pem"
-            with open(key_file, "w") as f:
-                f.write(ssh_key)
-            os.chmod(key_file, 0o400)
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(ec2_ip, username=SSH_USER, key_filename=key_file)
-            ssh.exec_command(f"rm -rf {PEERS_DIR}")
-            log(f"folder {PEERS_DIR} deleted before shutdown")
-            ssh.close()
-            os.remove(key_file)
-            
-            # Add a delay to ensure SSH completes
-            await asyncio.sleep(2)
+            try:
+                ssh = connect_ssh(ec2_ip, key_file)
+            finally:
+                os.remove(key_file)
+            with span("ssh_exec"):
+                stdin, stdout, stderr = ssh.exec_command(f"rm -rf {tenant.peers_dir}", timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+            cleanup = asyncio.to_thread(wait_cleanup, ssh, stdout.channel)
+        else:
+            cleanup = None
 
         # Stop the instance
-        log(f"stopping instance: {instance_id}")
-        ec2_client.stop_instances(InstanceIds=[instance_id])
-        await update.message.reply_text(f"Instance {instance_id} is stopping! Peers deleted.", reply_markup=MAIN_KEYBOARD)
+        def stop():
+            logger.info("stopping instance: %s (hibernate: %s)", instance_id, hibernate)
+            with span("ec2_stop"):
+                get_ec2(region)[0].stop_instances(InstanceIds=[instance_id], Hibernate=hibernate)
+        peers_deleted = True
+        if cleanup is None:
+            stop()
+        elif hibernate:
+            # Hibernation would freeze the rm wherever it is: let it finish first
+            peers_deleted = await cleanup
+            stop()
+        else:
+            # The rm is already running and the guest takes seconds to shut down,
+            # so the stop call overlaps with waiting for its exit status
+            peers_deleted, _ = await asyncio.gather(cleanup, asyncio.to_thread(stop))
+        clear_status()
+        if not peers_deleted:
+            action = "hibernating" if hibernate else "stopping"
+            await reply(update, f"Instance {instance_id} is {action}! Peer deletion did not finish, profiles may remain.", reply_markup=MAIN_KEYBOARD)
+        elif keep_peers:
+            await reply(update, f"Instance {instance_id} is hibernating! Peers kept.", reply_markup=MAIN_KEYBOARD)
+        elif hibernate:
+            await reply(update, f"Instance {instance_id} is hibernating! Peers deleted.", reply_markup=MAIN_KEYBOARD)
+        else:
+            await reply(update, f"Instance {instance_id} is stopping! Peers deleted.", reply_markup=MAIN_KEYBOARD)
     except Exception as e:
-        log(f"error in stop_ec2: {str(e)}")
-        await update.message.reply_text(f"Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+        logger.error("error in stop_ec2: %s", e)
+        await reply(update, f"Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+# List the peers on the instance at ec2_ip as an inline keyboard; only the one picked is downloaded
+async def offer_peers(update, region, instance_id, ec2_ip):
+    logger.info("SSH list peers, IP: %s", ec2_ip)
+    key_file = write_key_file()
+    if key_file is None:
+        await reply(update, "Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+        return
+    try:
+        ssh = connect_ssh(ec2_ip, key_file)
+    finally:
+        os.remove(key_file)
+    sftp = open_sftp(ssh)
+    
+    # Check if there are files in PEERS_DIR
+    try:
+        with span("sftp_list"):
+            files_in_dir = sftp.listdir(tenant.peers_dir)
+        if not files_in_dir:
+            await reply(update, "The peer profiles folder is empty!", reply_markup=MAIN_KEYBOARD)
+            sftp.close()
+            ssh.close()
+            return
+    except FileNotFoundError:
+        await reply(update, "The peer profiles folder is empty!", reply_markup=MAIN_KEYBOARD)
+        sftp.close()
+        ssh.close()
+        return
+
+    # List the peers found on the instance; only the one picked is downloaded
+    peers = sorted(int(name[4:]) for name in files_in_dir if name.startswith("peer") and name[4:].isdigit() and int(name[4:]) in tenant.peers)
+    sftp.close()
+    pool_ssh(ec2_ip, ssh)
+    if not peers:
+        await reply(update, "The peer profiles folder is empty!", reply_markup=MAIN_KEYBOARD)
+        return
+    # Button data stays JSON-compatible, so DynamoDBPersistence can store it. It names the
+    # instance, not its IP: send_peer looks the IP up again
+    instance = {"region": region, "instance": instance_id}
+    buttons = [InlineKeyboardButton(f"peer{number}", callback_data={**instance, "peer": number}) for number in peers]
+    rows = [buttons[i:i + PEER_BUTTONS_PER_ROW] for i in range(0, len(buttons), PEER_BUTTONS_PER_ROW)]
+    rows.append([InlineKeyboardButton("All peers", callback_data={**instance, "peer": None})])
+    await reply(update, "Choose a peer:", reply_markup=InlineKeyboardMarkup(rows))
 
 # Command: Fetch peer configuration files
+@timed_handler
+@single_flight
 async def get_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    log("called get_files")
+    logger.info("called get_files")
     if not check_access(update):
-        await update.message.reply_text("Access denied!")
+        await respond(update, "Access denied!")
         return
     try:
+        if tenant.fleet:
+            # The instance is picked first, pick_node then lists its peers (Telegram allows 100 buttons)
+            nodes = [node for node in describe_fleet("running") if node["ip"]][:100]
+            if not nodes:
+                await reply(update, "No running instances in the fleet!", reply_markup=MAIN_KEYBOARD)
+                return
+            buttons = [InlineKeyboardButton(node["name"] or node["id"], callback_data={"node": node["id"]}) for node in nodes]
+            rows = [buttons[i:i + FLEET_BUTTONS_PER_ROW] for i in range(0, len(buttons), FLEET_BUTTONS_PER_ROW)]
+            await reply(update, "Choose an instance:", reply_markup=InlineKeyboardMarkup(rows))
+            return
         # Find the instance by tag
-        response = ec2_client.describe_instances(
-            Filters=[
-                {
-                    "Name": f"tag:{EC2_TAG_KEY}",
-                    "Values": [EC2_TAG_VALUE]
-                },
-                {
-                    "Name": "instance-state-name",
-                    "Values": ["running"]
-                }
-            ]
-        )
+        region, response = await find_instance("running")
         instances = response["Reservations"]
         if not instances:
-            await update.message.reply_text("Instance not found or not running!", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance not found or not running!", reply_markup=MAIN_KEYBOARD)
             return
         
         instance = instances[0]["Instances"][0]
         ec2_ip = instance.get("PublicIpAddress", None)
         if not ec2_ip:
-            await update.message.reply_text("Instance has no public IP!", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance has no public IP!", reply_markup=MAIN_KEYBOARD)
             return
         
-        log(f"SSH get_files, IP: {ec2_ip}")
-        # Load SSH key from environment variable (expected to be Base64-encoded)
-        ssh_key_b64 = os.getenv("SSH_KEY")
-        if not ssh_key_b64:
-            log("SSH_KEY environment variable not set")
-            await update.message.reply_text("Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+        await offer_peers(update, region, instance["InstanceId"], ec2_ip)
+    except Exception as e:
+        logger.error("error in get_files: %s", e)
+        await reply(update, f"SSH Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+# Callback: instance picked on the fleet's "Get Peer Files" inline keyboard
+@timed_handler
+@single_flight
+async def pick_node(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    instance_id = query.data["node"]
+    logger.info("called pick_node: %s", instance_id)
+    if not check_access(update):
+        await query.answer()
+        await respond(update, "Access denied!", reply_markup=MAIN_KEYBOARD)
+        return
+    try:
+        ec2_ip = running_instance_ip(tenant.region, instance_id)
+        if not ec2_ip:
+            await expired_button(update, context)
             return
-        ssh_key = base64.b64decode(ssh_key_b64).decode("utf-8")
-        key_file = "/tmp/wireguard-key.pem"
-        with open(key_file, "w") as f:
-            f.write(ssh_key)
-        os.chmod(key_file, 0o400)
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(ec2_ip, username=SSH_USER, key_filename=key_file)
-        sftp = ssh.open_sftp()
-        
-        # Check if there are files in PEERS_DIR
+        await query.answer()
+        await offer_peers(update, tenant.region, instance_id, ec2_ip)
+    except Exception as e:
+        logger.error("error in pick_node: %s", e)
+        await reply(update, f"SSH Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+# Read peer N's files from the instance: [(data, filename, caption)] for the QR code and the .conf
+def read_peer_files(sftp, number):
+    documents = []
+    peer_dir = f"{tenant.peers_dir}/peer{number}"
+    # The QR code encodes the .conf, so with RENDER_QR only that is downloaded
+    files = [f"peer{number}.conf"] if RENDER_QR else [f"peer{number}.png", f"peer{number}.conf"]
+    for file_name in files:
+        remote_path = f"{peer_dir}/{file_name}"
+        logger.debug("trying to fetch file: %s", remote_path)
         try:
-            files_in_dir = sftp.listdir(PEERS_DIR)
-            if not files_in_dir:
-                await update.message.reply_text("The peer profiles folder is empty!", reply_markup=MAIN_KEYBOARD)
-                sftp.close()
-                ssh.close()
-                os.remove(key_file)
-                return
+            with span("sftp_read"):
+                with sftp.file(remote_path, "rb") as remote_file:
+                    file_data = remote_file.read()
         except FileNotFoundError:
-            await update.message.reply_text("The peer profiles folder is empty!", reply_markup=MAIN_KEYBOARD)
-            sftp.close()
-            ssh.close()
-            os.remove(key_file)
-            return
+            logger.debug("file not found: %s", remote_path)
+            continue  # Skip missing files
+        except Exception as e:
+            logger.error("error fetching file %s: %s", file_name, e)
+            continue
+        if RENDER_QR:
+            with span("qr_render"):
+                documents.append((qr_png(file_data), f"peer{number}.png", f"File peer{number}.png for peer{number}"))
+        documents.append((file_data, file_name, f"File {file_name} for peer{number}"))
+    return documents
 
-        # If the folder is not empty, download the files
-        for i in range(1, 8):
-            peer_dir = f"{PEERS_DIR}/peer{i}"
-            files = [f"peer{i}.png", f"peer{i}.conf"]
-            for file_name in files:
-                remote_path = f"{peer_dir}/{file_name}"
-                log(f"trying to fetch file: {remote_path}")
-                try:
-                    with sftp.file(remote_path, "rb") as remote_file:
-                        file_data = remote_file.read()
-                    file_stream = BytesIO(file_data)
-                    await update.message.reply_document(
-                        document=file_stream,
-                        filename=file_name,
-                        caption=f"File {file_name} for peer{i}",
-                        reply_markup=MAIN_KEYBOARD
-                    )
-                except FileNotFoundError:
-                    log(f"file not found: {remote_path}")
-                    continue  # Skip missing files
-                except Exception as e:
-                    log(f"error fetching file {file_name}: {str(e)}")
-                    continue
-        sftp.close()
-        ssh.close()
-        os.remove(key_file)
-        await update.message.reply_text("All files sent!", reply_markup=MAIN_KEYBOARD)
+# Upload documents to the chat, UPLOAD_WORKERS at a time (paced by the rate limiter).
+# A failed upload is re-queued behind the others, up to UPLOAD_ATTEMPTS; returns the
+# filenames that could not be sent
+async def send_documents(message, documents):
+    queue = deque((document, 1) for document in documents)
+    failed = []
+
+    async def worker():
+        while queue:
+            (data, filename, caption), attempt = queue.popleft()
+            try:
+                await message.reply_document(document=BytesIO(data), filename=filename, caption=caption, reply_markup=MAIN_KEYBOARD)
+            except Exception as e:
+                logger.error("error sending file %s (attempt %d): %s", filename, attempt, e)
+                if attempt < UPLOAD_ATTEMPTS and deadline.remaining() > 0:
+                    queue.append(((data, filename, caption), attempt + 1))
+                else:
+                    failed.append(filename)
+
+    await asyncio.gather(*(worker() for _ in range(min(UPLOAD_WORKERS, len(queue)))))
+    return failed
+
+# Callback: peer picked on the "Get Peer Files" inline keyboard (None: all peers)
+@timed_handler
+@single_flight
+async def send_peer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    instance_id, number = query.data.get("instance"), query.data.get("peer")
+    logger.info("called send_peer: %s", number)
+    if not check_access(update):
+        await query.answer()
+        await respond(update, "Access denied!", reply_markup=MAIN_KEYBOARD)
+        return
+    try:
+        # Only the instance the keyboard was made for, while it runs (keyboards from before
+        # the buttons carried the instance id are expired too)
+        ec2_ip = running_instance_ip(query.data["region"], instance_id) if instance_id else None
+        if not ec2_ip:
+            await expired_button(update, context)
+            return
+        await query.answer()
+        logger.info("SSH send_peer, IP: %s", ec2_ip)
+        key_file = write_key_file()
+        if key_file is None:
+            await reply(update, "Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+            return
+        try:
+            ssh = connect_ssh(ec2_ip, key_file)
+        finally:
+            os.remove(key_file)
+        sftp = open_sftp(ssh)
+        try:
+            numbers = [number] if number is not None else tenant.peers
+            documents = [document for i in numbers for document in read_peer_files(sftp, i)]
+        finally:
+            sftp.close()
+        pool_ssh(ec2_ip, ssh)
+        failed = await send_documents(query.message, documents)
+        if not documents:
+            await reply(update, "No peer files found!", reply_markup=MAIN_KEYBOARD)
+        elif failed:
+            await reply(update, f"Could not send {', '.join(failed)}, press the button again.", reply_markup=MAIN_KEYBOARD)
+        elif number is None:
+            await reply(update, "All files sent!", reply_markup=MAIN_KEYBOARD)
+        else:
+            await reply(update, f"Files for peer{number} sent!", reply_markup=MAIN_KEYBOARD)
     except Exception as e:
-        log(f"error in get_files: {str(e)}")
-        await update.message.reply_text(f"SSH Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+        logger.error("error in send_peer: %s", e)
+        await reply(update, f"SSH Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+# Callback: button of a keyboard this container no longer knows (cold start, or evicted from the cache)
+async def expired_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("received expired callback data")
+    query = update.callback_query
+    text = "This peer list has expired, press Get Peer Files again."
+    payload = {"method": "answerCallbackQuery", "callback_query_id": query.id, "text": text, "show_alert": True}
+    if not hold_webhook_reply(payload, lambda: query.answer(text, show_alert=True)):
+        await query.answer(text, show_alert=True)
 
 # Command: Get instance information with peer status
+@timed_handler
 async def get_instance_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    log("called get_instance_info")
+    logger.info("called get_instance_info")
     if not check_access(update):
-        await update.message.reply_text("Access denied!")
+        await respond(update, "Access denied!")
+        return
+    if tenant.fleet:
+        try:
+            await fleet_status(update)
+        except Exception as e:
+            logger.error("error in get_instance_info: %s", e)
+            await reply(update, f"Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+        return
+    # The monitor just pushed an idle shutdown: answer from the cache, no EC2/SSH calls. Only
+    # briefly: the instance may be started again from the console or another container
+    status = load_status()
+    if status and status["event"] in ("peers_deleted", "shutting_down") and time.time() - status["received"] <= STATUS_ANSWER_TTL:
+        logger.info("status from monitor cache: %s", status['event'])
+        await respond(
+            update,
+            f"Instance Information:\n"
+            f"State: stopped (idle shutdown at {time.strftime('%H:%M UTC', time.gmtime(status['time']))})\n"
+            f"Peers: absent",
+            reply_markup=MAIN_KEYBOARD
+        )
         return
     try:
         # Find the instance by tag
-        response = ec2_client.describe_instances(
-            Filters=[
-                {
-                    "Name": f"tag:{EC2_TAG_KEY}",
-                    "Values": [EC2_TAG_VALUE]
-                }
-            ]
-        )
+        region, response = await find_instance()
         instances = response["Reservations"]
         if not instances:
-            await update.message.reply_text("Instance not found!", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance not found!", reply_markup=MAIN_KEYBOARD)
             return
 
         # Get the first matching instance
@@ -325,31 +2056,26 @@ async def get_instance_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
         instance_id = instance["InstanceId"]
         state = instance["State"]["Name"]
         external_ip = instance.get("PublicIpAddress", "IP not assigned")
-        log(f"instance public IP: {external_ip}")
+        logger.info("instance public IP: %s", external_ip)
 
         # Get uptime via SSH if the instance is running
         uptime = "Could not retrieve uptime (instance not running)"
         peers_info = "Peers: absent"
         if state == "running" and external_ip != "IP not assigned":
-            # Load SSH key from environment variable (expected to be Base64-encoded)
-            ssh_key_b64 = os.getenv("SSH_KEY")
-            if not ssh_key_b64:
-                log("SSH_KEY environment variable not set")
-                await update.message.reply_text("Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+            key_file = write_key_file()
+            if key_file is None:
+                await reply(update, "Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
                 return
-            ssh_key = base64.b64decode(ssh_key_b64).decode("utf-8")
-            key_file = "/tmp/wireguard-key.pem"
-            with open(key_file, "w") as f:
-                f.write(ssh_key)
-            os.chmod(key_file, 0o400)
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(external_ip, username=SSH_USER, key_filename=key_file)
+            try:
+                ssh = connect_ssh(external_ip, key_file)
+            finally:
+                os.remove(key_file)
             
             # Check for peers
-            sftp = ssh.open_sftp()
+            sftp = open_sftp(ssh)
             try:
-                files_in_dir = sftp.listdir(PEERS_DIR)
+                with span("sftp_list"):
+                    files_in_dir = sftp.listdir(tenant.peers_dir)
                 if files_in_dir:
                     peers_info = "Peers: present"
             except FileNotFoundError:
@@ -358,21 +2084,23 @@ async def get_instance_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
             # Get uptime
             try:
-                stdin, stdout, stderr = ssh.exec_command("uptime")
-                uptime = stdout.read().decode().strip()
-                log(f"uptime: {uptime}")
+                with span("ssh_exec"):
+                    stdin, stdout, stderr = ssh.exec_command("uptime", timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+                    uptime = stdout.read().decode().strip()
+                logger.debug("uptime: %s", uptime)
             except Exception as e:
-                log(f"error getting uptime: {str(e)}")
+                logger.error("error getting uptime: %s", e)
                 uptime = f"Uptime retrieval error: {str(e)}"
             
             ssh.close()
-            os.remove(key_file)
 
         context.user_data["external_ip"] = external_ip  # Save IP for subsequent commands
 
-        await update.message.reply_text(
+        await reply(
+            update,
             f"Instance Information:\n"
             f"Instance ID: {instance_id}\n"
+            f"Region: {region}\n"
             f"State: {state}\n"
             f"Public IP: {external_ip}\n"
             f"{peers_info}\n"
@@ -380,120 +2108,420 @@ async def get_instance_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=MAIN_KEYBOARD
         )
     except Exception as e:
-        log(f"error in get_instance_info: {str(e)}")
-        await update.message.reply_text(f"Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+        logger.error("error in get_instance_info: %s", e)
+        await reply(update, f"Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
 
 # Command: Delete and recreate peers
+@timed_handler
+@single_flight
 async def recreate_peers(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    log("called recreate_peers")
+    logger.info("called recreate_peers")
     if not check_access(update):
-        await update.message.reply_text("Access denied!")
+        await respond(update, "Access denied!")
+        return
+    if tenant.fleet:
+        await respond(update, "Recreate Peers works on a single instance, it is not available in fleet mode.", reply_markup=MAIN_KEYBOARD)
         return
     try:
         # Find the instance by tag
-        response = ec2_client.describe_instances(
-            Filters=[
-                {
-                    "Name": f"tag:{EC2_TAG_KEY}",
-                    "Values": [EC2_TAG_VALUE]
-                },
-                {
-                    "Name": "instance-state-name",
-                    "Values": ["running"]
-                }
-            ]
-        )
+        region, response = await find_instance("running")
         instances = response["Reservations"]
         if not instances:
-            await update.message.reply_text("Instance not found or not running!", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance not found or not running!", reply_markup=MAIN_KEYBOARD)
             return
         
         instance = instances[0]["Instances"][0]
         ec2_ip = instance.get("PublicIpAddress", None)
         if not ec2_ip:
-            await update.message.reply_text("Instance has no public IP!", reply_markup=MAIN_KEYBOARD)
+            await reply(update, "Instance has no public IP!", reply_markup=MAIN_KEYBOARD)
             return
 
-        log(f"SSH recreate_peers, IP: {ec2_ip}")
-        # Load SSH key from environment variable (expected to be Base64-encoded)
-        ssh_key_b64 = os.getenv("SSH_KEY")
-        if not ssh_key_b64:
-            log("SSH_KEY environment variable not set")
-            await update.message.reply_text("Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+        logger.info("SSH recreate_peers, IP: %s", ec2_ip)
+        key_file = write_key_file()
+        if key_file is None:
+            await reply(update, "Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+            return
+        try:
+            ssh = connect_ssh(ec2_ip, key_file)
+        finally:
+            os.remove(key_file)
+
+        # "native": new keys swapped into the running interface, nothing restarts.
+        # A tenant sharing the instance always goes this way: a restart would reset the other tenants' peers
+        if RECREATE_MODE == "native" or not tenant.owns_all_peers:
+            applied = time.monotonic()
+            with span("peer_apply"):
+                confs = await asyncio.to_thread(apply_peers, ssh, ec2_ip, tenant.peers)
+            pool_ssh(ec2_ip, ssh)
+            await reply(update, f"Peers recreated! {len(confs)} new profiles applied live in {time.monotonic() - applied:.1f} s, no restart.", reply_markup=MAIN_KEYBOARD)
             return
-        ssh_key = base64.b64decode(ssh_key_b64).decode("utf-8")
-        key_file = "/tmp/wireguard-key.pem"
-        with open(key_file, "w") as f:
-            f.write(ssh_key)
-        os.chmod(key_file, 0o400)
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(ec2_ip, username=SSH_USER, key_filename=key_file)
         
         # Check for existing peers
-        sftp = ssh.open_sftp()
+        sftp = open_sftp(ssh)
         peers_exist = False
         try:
-            files_in_dir = sftp.listdir(PEERS_DIR)
+            with span("sftp_list"):
+                files_in_dir = sftp.listdir(tenant.peers_dir)
             if files_in_dir:
                 peers_exist = True
-                log(f"peers found in {PEERS_DIR}, will delete")
-                ssh.exec_command(f"rm -rf {PEERS_DIR}")
-                log(f"folder {PEERS_DIR} deleted")
+                logger.info("peers found in %s, will delete", tenant.peers_dir)
             else:
-                log(f"no peers in {PEERS_DIR}, skipping deletion")
+                logger.info("no peers in %s, skipping deletion", tenant.peers_dir)
         except FileNotFoundError:
-            log(f"directory {PEERS_DIR} does not exist, skipping deletion")
+            logger.info("directory %s does not exist, skipping deletion", tenant.peers_dir)
         sftp.close()
 
-        # Restart docker-compose
-        command = f"cd {DOCKER_COMPOSE_DIR} && docker-compose down && docker-compose up -d"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        exit_status = stdout.channel.recv_exit_status()
+        # "wireguard": the container regenerates the deleted peers on restart (server keys are kept),
+        # Pi-hole and the bridge network stay up. "stack": delete everything and recreate the whole stack
+        if RECREATE_MODE == "stack":
+            cleanup = f"rm -rf {tenant.peers_dir}"
+            command = f"cd {tenant.docker_compose_dir} && docker-compose down && docker-compose up -d"
+            containers = READY_CONTAINERS
+        else:
+            cleanup = f"rm -rf {tenant.peers_dir}/peer* {tenant.peers_dir}/.donoteditthisfile"
+            command = f"cd {tenant.docker_compose_dir} && docker-compose restart wireguard"
+            containers = ("wireguard",)
+
+        # The old profiles must be gone before the container starts, or it keeps them
+        if peers_exist:
+            with span("ssh_exec"):
+                stdin, stdout, stderr = ssh.exec_command(cleanup, timeout=deadline.timeout(SSH_CONNECT_TIMEOUT, "remote command"))
+                exit_status = wait_exit_status(stdout.channel, SSH_CONNECT_TIMEOUT)
+            if exit_status != 0:
+                error_output = stderr.read().decode().strip()
+                logger.error("error deleting peers: %s", error_output)
+                await reply(update, f"Error deleting peers: {error_output}", reply_markup=MAIN_KEYBOARD)
+                ssh.close()
+                return
+            logger.info("peers deleted from %s", tenant.peers_dir)
+
+        # Downtime: from the restart until the containers run again and the first profile exists
+        down_started = time.monotonic()
+        try:
+            with span("ssh_exec"):
+                stdin, stdout, stderr = ssh.exec_command(command, timeout=deadline.timeout(SSH_COMMAND_TIMEOUT, "remote command"))
+                exit_status = wait_exit_status(stdout.channel)
+            if exit_status == 0:
+                await asyncio.to_thread(wait_containers, ssh, containers, f" && test -f {tenant.peers_dir}/peer1/peer1.conf")
+        except DeadlineExceeded as e:
+            # docker-compose keeps running on the instance, hand off to the user
+            logger.warning("docker-compose not finished before the deadline: %s", e)
+            await reply(update, "Peers are being recreated, docker-compose is still restarting.\nPress Get Peer Files in a minute.", reply_markup=MAIN_KEYBOARD)
+            ssh.close()
+            return
+        downtime = time.monotonic() - down_started
         if exit_status != 0:
             error_output = stderr.read().decode().strip()
-            log(f"error restarting docker-compose: {error_output}")
-            await update.message.reply_text(f"Error restarting docker-compose: {error_output}", reply_markup=MAIN_KEYBOARD)
+            logger.error("error restarting docker-compose: %s", error_output)
+            await reply(update, f"Error restarting docker-compose: {error_output}", reply_markup=MAIN_KEYBOARD)
         else:
-            log(f"docker-compose restarted in {DOCKER_COMPOSE_DIR}")
+            logger.info("docker-compose restarted in %s (%s), downtime %.1f s", tenant.docker_compose_dir, RECREATE_MODE, downtime)
+            record_timing(f"recreate_peers.downtime_{RECREATE_MODE}", downtime * 1000)
+            if RECREATE_MODE == "stack":
+                restarted = f"docker-compose restarted.\nVPN and DNS downtime: {downtime:.0f} s."
+            else:
+                restarted = f"WireGuard restarted.\nVPN downtime: {downtime:.0f} s (Pi-hole stayed up)."
             if peers_exist:
-                await update.message.reply_text("Peers recreated! Old profiles deleted, docker-compose restarted.", reply_markup=MAIN_KEYBOARD)
+                await reply(update, f"Peers recreated! Old profiles deleted, {restarted}", reply_markup=MAIN_KEYBOARD)
             else:
-                await update.message.reply_text("Peers created! docker-compose restarted.", reply_markup=MAIN_KEYBOARD)
+                await reply(update, f"Peers created! {restarted}", reply_markup=MAIN_KEYBOARD)
 
         ssh.close()
-        os.remove(key_file)
     except Exception as e:
-        log(f"error in recreate_peers: {str(e)}")
-        await update.message.reply_text(f"SSH Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+        logger.error("error in recreate_peers: %s", e)
+        await reply(update, f"SSH Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+# Command: /rotate N (hidden) - new keys for peer N (added if missing), applied live, new profile sent
+@timed_handler
+@single_flight
+async def rotate_peer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("called /rotate command")
+    if not check_access(update):
+        await respond(update, "Access denied!", reply_markup=MAIN_KEYBOARD)
+        return
+    if tenant.fleet:
+        await respond(update, "/rotate works on a single instance, it is not available in fleet mode.", reply_markup=MAIN_KEYBOARD)
+        return
+    if not context.args or not context.args[0].isdigit() or int(context.args[0]) not in tenant.peers:
+        peers = f"1-{PEER_COUNT}" if tenant.owns_all_peers else ", ".join(map(str, tenant.peers))
+        await respond(update, f"Usage: /rotate N ({peers})", reply_markup=MAIN_KEYBOARD)
+        return
+    number = int(context.args[0])
+    try:
+        # Find the instance by tag
+        region, response = await find_instance("running")
+        instances = response["Reservations"]
+        if not instances:
+            await reply(update, "Instance not found or not running!", reply_markup=MAIN_KEYBOARD)
+            return
+        ec2_ip = instances[0]["Instances"][0].get("PublicIpAddress", None)
+        if not ec2_ip:
+            await reply(update, "Instance has no public IP!", reply_markup=MAIN_KEYBOARD)
+            return
+
+        logger.info("SSH rotate_peer %d, IP: %s", number, ec2_ip)
+        key_file = write_key_file()
+        if key_file is None:
+            await reply(update, "Error: SSH_KEY environment variable not set!", reply_markup=MAIN_KEYBOARD)
+            return
+        try:
+            ssh = connect_ssh(ec2_ip, key_file)
+        finally:
+            os.remove(key_file)
+        applied = time.monotonic()
+        with span("peer_apply"):
+            confs = await asyncio.to_thread(apply_peers, ssh, ec2_ip, [number])
+        pool_ssh(ec2_ip, ssh)
+        documents = []
+        if RENDER_QR:
+            with span("qr_render"):
+                documents.append((qr_png(confs[number].encode()), f"peer{number}.png", f"File peer{number}.png for peer{number}"))
+        documents.append((confs[number].encode(), f"peer{number}.conf", f"File peer{number}.conf for peer{number}"))
+        failed = await send_documents(update.message, documents)
+        text = f"Peer {number} rotated in {time.monotonic() - applied:.1f} s, the old profile no longer connects."
+        if failed:
+            text += f"\nCould not send {', '.join(failed)}, use Get Peer Files."
+        await reply(update, text, reply_markup=MAIN_KEYBOARD)
+    except Exception as e:
+        logger.error("error in rotate_peer: %s", e)
+        await reply(update, f"SSH Error: {str(e)}", reply_markup=MAIN_KEYBOARD)
+
+# Command: /timings (hidden) - p50/p95 per span over the recent samples
+async def show_timings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("called /timings command")
+    if not check_access(update):
+        await respond(update, "Access denied!", reply_markup=MAIN_KEYBOARD)
+        return
+    lines = []
+    for name, samples in sorted(load_timings().items()):
+        ordered = sorted(samples)
+        p50 = ordered[(len(ordered) - 1) // 2]
+        p95 = ordered[max(0, round(0.95 * len(ordered)) - 1)]
+        lines.append(f"{name}: p50 {p50:.0f} ms, p95 {p95:.0f} ms (n={len(ordered)})")
+    await respond(update, "\n".join(lines) or "No timings recorded yet.", reply_markup=MAIN_KEYBOARD)
+
+# Command: /profile N (hidden) - profile the next N invocations; /profile - summary of the last one
+async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global profile_remaining
+    logger.info("called /profile command")
+    if not check_access(update):
+        await respond(update, "Access denied!", reply_markup=MAIN_KEYBOARD)
+        return
+    if context.args and context.args[0].isdigit():
+        profile_remaining = int(context.args[0])
+        await respond(update, f"Profiling the next {profile_remaining} invocations.", reply_markup=MAIN_KEYBOARD)
+        return
+    try:
+        with open(f"{PROFILE_DIR}/summary.txt", "r") as f:
+            summary = f.read()
+    except FileNotFoundError:
+        summary = "No profile recorded yet. Use /profile N to profile the next N invocations."
+    # Telegram messages are limited to 4096 characters
+    await respond(update, summary[:4000], reply_markup=MAIN_KEYBOARD)
+
+# Chat messages for lifecycle events pushed by check_wg.py
+MONITOR_MESSAGES = {
+    "wireguard_up": "WireGuard is up!",
+    "idle_countdown_started": "No VPN activity for {idle_minutes} min, the instance will stop in about {shutdown_minutes} min.",
+    "peers_deleted": "Idle shutdown: peer profiles deleted.",
+    "shutting_down": "Idle shutdown: instance is shutting down.",
+}
+
+# Peer RTT measured by check_wg.py in the instance's region: a sample for Start EC2's choice of region.
+# No chat message; with PERSISTENCE_TABLE, initialize/shutdown load and write bot_data
+def handle_latency_event(data):
+    region = data.get("region") or tenant.region
+    if not isinstance(data.get("rtt_ms"), (int, float)):
+        return {"statusCode": 400, "body": "Missing rtt_ms"}
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        if application.persistence is not None:
+            loop.run_until_complete(application.initialize())
+        record_region_rtt(region, data["rtt_ms"])
+        logger.info("peer RTT in %s: %.1f ms, median %.1f ms", region, data["rtt_ms"], region_rtt(region))
+    finally:
+        if application.persistence is not None:
+            loop.run_until_complete(application.shutdown())
+        loop.close()
+    return {"statusCode": 200, "body": "OK"}
+
+# Lifecycle event from check_wg.py: update the tenant's status cache and tell its chat
+def handle_monitor_event(event, data):
+    global tenant
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    monitor_secret = os.getenv("MONITOR_SECRET")
+    if not monitor_secret or not hmac.compare_digest(headers.get("x-monitor-secret", ""), monitor_secret):
+        logger.warning("monitor event rejected: bad secret")
+        return {"statusCode": 403, "body": "Forbidden"}
+    name = data["monitor_event"]
+    if name not in MONITOR_MESSAGES and name != "latency":
+        logger.warning("unknown monitor event: %s", name)
+        return {"statusCode": 400, "body": "Unknown event"}
+    # check_wg.py names its tenant (NOTIFY_TENANT); a single-tenant deployment needs no name
+    if "tenant" in data:
+        tenant = tenants_by_name.get(data["tenant"])
+    elif len(tenants_by_name) == 1:
+        tenant = next(iter(tenants_by_name.values()))
+    if tenant is None:
+        logger.warning("monitor event for unknown tenant: %s", data.get("tenant"))
+        return {"statusCode": 400, "body": "Unknown tenant"}
+    logger.info("monitor event: %s (tenant %s)", name, tenant.name)
+    if name == "latency":
+        return handle_latency_event(data)
+    previous = load_status()
+    if name == "wireguard_up":
+        # Started again, by whoever: an idle-shutdown status no longer holds, also for the
+        # tenants sharing the instance (the monitor names only one)
+        clear_shutdown_status(tenant.instance_key)
+    if name == "wireguard_up" and previous and previous.get("event") == "wireguard_up":
+        # start_ec2 already saw WireGuard come up and said so
+        save_status({"event": name, "time": data.get("time", int(time.time())), "received": time.time()})
+        return {"statusCode": 200, "body": "OK"}
+    event_time = data.get("time", int(time.time()))
+    save_status({"event": name, "time": event_time, "received": time.time()})
+    text = MONITOR_MESSAGES[name].format(
+        idle_minutes=data.get("idle_seconds", 0) // 60,
+        shutdown_minutes=data.get("shutdown_in", 0) // 60
+    )
+    # Start-to-ready time, split by cold boot vs resume from hibernation
+    if name == "wireguard_up" and previous and previous.get("event") == "starting":
+        mode = previous.get("mode", "boot")
+        elapsed = max(0, event_time - previous["started"])
+        record_timing(f"start_ec2.wireguard_ready_{mode}", elapsed * 1000)
+        save_timings()
+        text += f"\nReady {elapsed:.0f}s after Start ({'resumed from hibernation' if mode == 'resume' else 'cold boot'})."
+    if tenant.notify_chat_id is None:
+        logger.warning("tenant %s has no chat to notify", tenant.name)
+        return {"statusCode": 200, "body": "OK"}
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(application.initialize())
+        loop.run_until_complete(application.bot.send_message(chat_id=tenant.notify_chat_id, text=text, reply_markup=MAIN_KEYBOARD))
+    finally:
+        loop.run_until_complete(application.shutdown())
+        loop.close()
+    return {"statusCode": 200, "body": "OK"}
 
 # Add command handlers
 application.add_handler(CommandHandler("start", start))
+application.add_handler(CommandHandler("timings", show_timings))
+application.add_handler(CommandHandler("profile", show_profile))
+application.add_handler(CommandHandler("rotate", rotate_peer))
+application.add_handler(CallbackQueryHandler(pick_node, pattern=lambda data: isinstance(data, dict) and "node" in data))
+application.add_handler(CallbackQueryHandler(send_peer, pattern=dict))
+application.add_handler(CallbackQueryHandler(expired_button, pattern=InvalidCallbackData))
 application.add_handler(MessageHandler(Text(), handle_buttons))
 
+# Button text -> handler, for handle_buttons and the pre-dispatch stage
+BUTTON_HANDLERS = {
+    "Start EC2": start_ec2,
+    "Stop EC2": stop_ec2,
+    "Check Status": get_instance_info,
+    "Get Peer Files": get_files,
+    "Recreate Peers": recreate_peers,
+}
+# Commands registered above
+COMMANDS = {"/start", "/timings", "/profile", "/rotate"}
+
+# Pre-dispatch on the raw update dict: returns the webhook response for updates
+# no handler needs to see, or None to build the Update and process it
+def pre_dispatch(update_data):
+    query = update_data.get("callback_query")
+    message = query.get("message") if query is not None else update_data.get("message")
+    if message is None:
+        # Edited messages, channel posts, membership changes...: nothing to do
+        logger.info("ignored update without message")
+        return {"statusCode": 200, "body": "OK"}
+    chat = message.get("chat") or {}
+    text = message.get("text")
+    if query is None and not text:
+        # Stickers, photos...: no text handler would match
+        logger.info("ignored message without text")
+        return {"statusCode": 200, "body": "OK"}
+    if chat_allowed(chat.get("id")):
+        if query is not None:
+            return None
+        if text in BUTTON_HANDLERS or (text.split() or [""])[0].split("@")[0] in COMMANDS:
+            return None
+        logger.warning("unknown button: %s", text)
+        reply_text = "Unknown action!"
+    else:
+        logger.warning("access denied for chat %s", chat.get("id"))
+        reply_text = "Access denied!"
+    # Without the webhook response the reply needs the Bot API: let the handlers send it
+    if not RESPOND_IN_WEBHOOK:
+        return None
+    if query is not None:
+        payload = {"method": "answerCallbackQuery", "callback_query_id": query["id"], "text": reply_text}
+    else:
+        payload = message_payload(chat.get("id"), chat.get("type"), message.get("message_id"), reply_text, MAIN_KEYBOARD)
+    return {"statusCode": 200, "headers": {"Content-Type": "application/json"}, "body": json.dumps(payload)}
+
 # Main Lambda handler
 def lambda_handler(event, context):
+    global deadline, webhook_open, tenant
+    deadline = Deadline(context.get_remaining_time_in_millis() if context else 15 * 60 * 1000)
+    tenant = None
+    claimed = None
+    start_trace(context)
+    profiler = start_profile()
     try:
-        log("received request from Telegram")
-        log(f"raw request data: {json.dumps(event)}")
+        logger.info("received request from Telegram")
+        logger.debug("raw request data: %s", event)
         update_data = json.loads(event["body"])
-        log(f"update data: {json.dumps(update_data)}")
+        if "monitor_event" in update_data:
+            return handle_monitor_event(event, update_data)
+        logger.debug("update data: %s", update_data)
+        if PRE_DISPATCH:
+            with span("pre_dispatch"):
+                response = pre_dispatch(update_data)
+            if response is not None:
+                return response
+        update_id = update_data.get("update_id")
+        if update_id is not None and not claim_update(update_id):
+            logger.info("duplicate update %s, acknowledged without processing", update_id)
+            return {"statusCode": 200, "body": "OK"}
+        claimed = update_id
         update = Update.de_json(update_data, application.bot)
         if update is None:
-            log("failed to create Update object")
+            logger.warning("failed to create Update object")
             return {"statusCode": 200, "body": "OK"}
-        log("Update object created")
+        logger.debug("Update object created")
+        # Handlers act on the tenant of the chat (None: check_access denies)
+        tenant = tenants_by_chat.get(update.effective_chat.id) if update.effective_chat else None
+        webhook_open = True
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         try:
-            loop.run_until_complete(application.initialize())
-            loop.run_until_complete(application.process_update(update))
-            log("request processed")
+            with span("initialize"):
+                loop.run_until_complete(application.initialize())
+            # Resolve inline button data from the callback data cache (the webhook server would
+            # do this), after initialize has loaded the persisted keyboards
+            application.bot.insert_callback_data(update)
+            with span("process_update"):
+                loop.run_until_complete(application.process_update(update))
+            logger.info("request processed")
         finally:
+            payload = take_webhook_reply()
             loop.run_until_complete(application.shutdown())
             loop.close()
+            save_timings()
+        if payload is not None:
+            logger.info("answered with %s in the webhook response", payload["method"])
+            if trace is not None:
+                trace["telegram"].append({"method": payload["method"], "webhook_response": True})
+            return {"statusCode": 200, "headers": {"Content-Type": "application/json"}, "body": json.dumps(payload)}
         return {"statusCode": 200, "body": "OK"}
     except Exception as e:
         error_msg = f"error in Lambda: {str(e)}\n{traceback.format_exc()}"
-        log(error_msg)
-        raise Exception(error_msg)
\ No newline at end of file
+        logger.error(error_msg)
+        if claimed is not None:
+            # Telegram redelivers after the error; the retry must not be taken for a duplicate
+            release_update(claimed)
+        raise Exception(error_msg)
+    finally:
+        finish_profile(profiler)
+        emit_trace()
+        log_buffer.flush()
\ No newline at end of file
@@ -0,0 +1,312 @@
+# QR codes as 1-bit PNGs, self-contained (zlib only)
+# Byte mode, versions 1-40, all four error correction levels, automatic mask selection.
+# Used by the bot to render peer QR codes from peerN.conf instead of downloading peerN.png
+
+import re
+import zlib
+import struct
+
+# Error correction levels: format bits of each level
+LEVELS = {"L": 1, "M": 0, "Q": 3, "H": 2}
+
+# Error correction codewords per block, indexed [level][version] (index 0 unused)
+ECC_CODEWORDS_PER_BLOCK = {
+    "L": (-1, 7, 10, 15, 20, 26, 18, 20, 24, 30, 18, 20, 24, 26, 30, 22, 24, 28, 30, 28, 28, 28, 28, 30, 30, 26, 28, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+    "M": (-1, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26, 26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28),
+    "Q": (-1, 13, 22, 18, 26, 18, 24, 18, 22, 20, 24, 28, 26, 24, 20, 30, 24, 28, 28, 26, 30, 28, 30, 30, 30, 30, 28, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+    "H": (-1, 17, 28, 22, 16, 22, 28, 26, 26, 24, 28, 24, 28, 22, 24, 24, 30, 28, 28, 26, 28, 30, 24, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+}
+
+# Error correction blocks, indexed [level][version] (index 0 unused)
+ECC_BLOCKS = {
+    "L": (-1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 4, 4, 4, 4, 4, 6, 6, 6, 6, 7, 8, 8, 9, 9, 10, 12, 12, 12, 13, 14, 15, 16, 17, 18, 19, 19, 20, 21, 22, 24, 25),
+    "M": (-1, 1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13, 14, 16, 17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49),
+    "Q": (-1, 1, 1, 2, 2, 4, 4, 6, 6, 8, 8, 8, 10, 12, 16, 12, 17, 16, 18, 21, 20, 23, 23, 25, 27, 29, 34, 34, 35, 38, 40, 43, 45, 48, 51, 53, 56, 59, 62, 65, 68),
+    "H": (-1, 1, 1, 2, 4, 4, 4, 5, 6, 8, 8, 11, 11, 16, 16, 18, 16, 19, 21, 25, 25, 25, 34, 30, 32, 35, 37, 40, 42, 45, 48, 51, 54, 57, 60, 63, 66, 70, 74, 77, 81),
+}
+
+# Data masks: a module is flipped where the pattern is true
+MASKS = (
+    lambda x, y: (x + y) % 2 == 0,
+    lambda x, y: y % 2 == 0,
+    lambda x, y: x % 3 == 0,
+    lambda x, y: (x + y) % 3 == 0,
+    lambda x, y: (x // 3 + y // 2) % 2 == 0,
+    lambda x, y: x * y % 2 + x * y % 3 == 0,
+    lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+    lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+)
+
+# Penalty patterns: runs of 5+ same-colour modules, finder-like 1:1:3:1:1 with 4 light modules on a side
+RUNS = re.compile(r"0{5,}|1{5,}")
+FINDER_LIKE = re.compile(r"(?=10111010000|00001011101)")
+
+# Modules available for data + error correction in a version (everything minus function patterns)
+def raw_data_modules(version):
+    result = (16 * version + 128) * version + 64
+    if version >= 2:
+        alignments = version // 7 + 2
+        result -= (25 * alignments - 10) * alignments - 55
+        if version >= 7:
+            result -= 36
+    return result
+
+def data_codewords(version, level):
+    return raw_data_modules(version) // 8 - ECC_CODEWORDS_PER_BLOCK[level][version] * ECC_BLOCKS[level][version]
+
+# Reed-Solomon over GF(2^8) with the QR polynomial x^8 + x^4 + x^3 + x^2 + 1 (log/antilog tables)
+def gf_tables():
+    exp, log = [0] * 510, [0] * 256
+    value = 1
+    for exponent in range(255):
+        exp[exponent] = exp[exponent + 255] = value
+        log[value] = exponent
+        value <<= 1
+        if value & 0x100:
+            value ^= 0x11D
+    return exp, log
+
+GF_EXP, GF_LOG = gf_tables()
+
+def gf_multiply(x, y):
+    if x == 0 or y == 0:
+        return 0
+    return GF_EXP[GF_LOG[x] + GF_LOG[y]]
+
+def rs_divisor(degree):
+    result = [0] * (degree - 1) + [1]
+    root = 1
+    for _ in range(degree):
+        for j in range(degree):
+            result[j] = gf_multiply(result[j], root)
+            if j + 1 < degree:
+                result[j] ^= result[j + 1]
+        root = gf_multiply(root, 0x02)
+    return result
+
+def rs_remainder(data, divisor):
+    result = [0] * len(divisor)
+    for byte in data:
+        factor = byte ^ result.pop(0)
+        result.append(0)
+        for i, coefficient in enumerate(divisor):
+            result[i] ^= gf_multiply(coefficient, factor)
+    return result
+
+# Byte-mode segment, terminator and padding, as codewords
+def encode_data(data, version, level):
+    bits = []
+
+    def append(value, length):
+        bits.extend((value >> i) & 1 for i in reversed(range(length)))
+
+    append(0b0100, 4)
+    append(len(data), 8 if version <= 9 else 16)
+    for byte in data:
+        append(byte, 8)
+    capacity = data_codewords(version, level) * 8
+    append(0, min(4, capacity - len(bits)))
+    append(0, -len(bits) % 8)
+    pad = 0xEC
+    while len(bits) < capacity:
+        append(pad, 8)
+        pad ^= 0xEC ^ 0x11
+    return [int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8)]
+
+# Split into blocks, add error correction to each and interleave
+def add_ecc(codewords, version, level):
+    blocks_count = ECC_BLOCKS[level][version]
+    ecc_length = ECC_CODEWORDS_PER_BLOCK[level][version]
+    raw_codewords = raw_data_modules(version) // 8
+    short_blocks = blocks_count - raw_codewords % blocks_count
+    short_length = raw_codewords // blocks_count
+    divisor = rs_divisor(ecc_length)
+    blocks = []
+    k = 0
+    for i in range(blocks_count):
+        block = codewords[k:k + short_length - ecc_length + (0 if i < short_blocks else 1)]
+        k += len(block)
+        ecc = rs_remainder(block, divisor)
+        if i < short_blocks:
+            block = block + [0]  # Placeholder, skipped when interleaving
+        blocks.append(block + ecc)
+    result = []
+    for i in range(len(blocks[0])):
+        for j, block in enumerate(blocks):
+            if i != short_length - ecc_length or j >= short_blocks:
+                result.append(block[i])
+    return result
+
+def alignment_positions(version):
+    if version == 1:
+        return []
+    count = version // 7 + 2
+    step = (version * 8 + count * 3 + 5) // (count * 4 - 4) * 2
+    size = version * 4 + 17
+    return [6] + [size - 7 - i * step for i in reversed(range(count - 1))]
+
+class QRMatrix:
+    def __init__(self, version):
+        self.version = version
+        self.size = version * 4 + 17
+        self.modules = [[False] * self.size for _ in range(self.size)]
+        self.function = [[False] * self.size for _ in range(self.size)]
+
+    def set_function(self, x, y, dark):
+        self.modules[y][x] = dark
+        self.function[y][x] = True
+
+    def draw_function_patterns(self, level):
+        size = self.size
+        for i in range(size):
+            self.set_function(6, i, i % 2 == 0)
+            self.set_function(i, 6, i % 2 == 0)
+        for cx, cy in ((3, 3), (size - 4, 3), (3, size - 4)):
+            for dy in range(-4, 5):
+                for dx in range(-4, 5):
+                    x, y = cx + dx, cy + dy
+                    if 0 <= x < size and 0 <= y < size:
+                        self.set_function(x, y, max(abs(dx), abs(dy)) not in (2, 4))
+        positions = alignment_positions(self.version)
+        last = len(positions) - 1
+        for i, cx in enumerate(positions):
+            for j, cy in enumerate(positions):
+                # Not over the finder patterns
+                if (i, j) in ((0, 0), (0, last), (last, 0)):
+                    continue
+                for dy in range(-2, 3):
+                    for dx in range(-2, 3):
+                        self.set_function(cx + dx, cy + dy, max(abs(dx), abs(dy)) != 1)
+        self.draw_format_bits(level, 0)  # Reserve the area, redrawn with the chosen mask
+        if self.version >= 7:
+            remainder = self.version
+            for _ in range(12):
+                remainder = (remainder << 1) ^ ((remainder >> 11) * 0x1F25)
+            bits = self.version << 12 | remainder
+            for i in range(18):
+                dark = (bits >> i) & 1 == 1
+                a, b = size - 11 + i % 3, i // 3
+                self.set_function(a, b, dark)
+                self.set_function(b, a, dark)
+
+    def draw_format_bits(self, level, mask):
+        data = LEVELS[level] << 3 | mask
+        remainder = data
+        for _ in range(10):
+            remainder = (remainder << 1) ^ ((remainder >> 9) * 0x537)
+        bits = (data << 10 | remainder) ^ 0x5412
+        bit = lambda i: (bits >> i) & 1 == 1
+        size = self.size
+        for i in range(6):
+            self.set_function(8, i, bit(i))
+        self.set_function(8, 7, bit(6))
+        self.set_function(8, 8, bit(7))
+        self.set_function(7, 8, bit(8))
+        for i in range(9, 15):
+            self.set_function(14 - i, 8, bit(i))
+        for i in range(8):
+            self.set_function(size - 1 - i, 8, bit(i))
+        for i in range(8, 15):
+            self.set_function(8, size - 15 + i, bit(i))
+        self.set_function(8, size - 8, True)  # Always dark
+
+    # Codewords in the zigzag order: two-module columns from the right, alternating up and down
+    def draw_codewords(self, codewords):
+        size = self.size
+        i = 0
+        right = size - 1
+        while right >= 1:
+            if right == 6:
+                right = 5  # Skip the vertical timing pattern
+            upward = (right + 1) & 2 == 0
+            for vertical in range(size):
+                y = size - 1 - vertical if upward else vertical
+                for x in (right, right - 1):
+                    if not self.function[y][x] and i < len(codewords) * 8:
+                        self.modules[y][x] = (codewords[i >> 3] >> (7 - (i & 7))) & 1 == 1
+                        i += 1
+            right -= 2
+        # Remaining modules (0-7 remainder bits) stay light
+
+    def apply_mask(self, mask):
+        pattern = MASKS[mask]
+        for y in range(self.size):
+            row = self.modules[y]
+            function = self.function[y]
+            for x in range(self.size):
+                if not function[x] and pattern(x, y):
+                    row[x] = not row[x]
+
+    # Standard penalty rules: runs, 2x2 blocks, finder-like patterns, dark/light balance
+    def penalty(self):
+        size = self.size
+        rows = ["".join("1" if dark else "0" for dark in row) for row in self.modules]
+        score = 0
+        for line in rows + ["".join(column) for column in zip(*rows)]:
+            for run in RUNS.findall(line):
+                score += len(run) - 2
+            score += 40 * len(FINDER_LIKE.findall(line))
+        # 2x2 blocks, a row pair at a time: bit x is set where all four modules match
+        values = [int(row, 2) for row in rows]
+        inner = (1 << (size - 1)) - 1
+        for upper, lower in zip(values, values[1:]):
+            vertical = ~(upper ^ lower)
+            score += 3 * bin(vertical & (vertical >> 1) & ~(upper ^ (upper >> 1)) & inner).count("1")
+        dark = sum(row.count("1") for row in rows)
+        total = size * size
+        score += ((abs(dark * 20 - total * 10) + total - 1) // total - 1) * 10
+        return score
+
+# Smallest version that holds the data, masked with the lowest penalty (or the given mask)
+def qr_matrix(data, level="L", mask=None):
+    for version in range(1, 41):
+        header_bits = 4 + (8 if version <= 9 else 16)
+        if header_bits + len(data) * 8 <= data_codewords(version, level) * 8:
+            break
+    else:
+        raise ValueError(f"{len(data)} bytes do not fit in a QR code at level {level}")
+    codewords = add_ecc(encode_data(data, version, level), version, level)
+    unmasked = QRMatrix(version)
+    unmasked.draw_function_patterns(level)
+    unmasked.draw_codewords(codewords)
+    best = None
+    for candidate in range(8) if mask is None else (mask,):
+        matrix = QRMatrix(version)
+        matrix.modules = [row[:] for row in unmasked.modules]
+        matrix.function = unmasked.function
+        matrix.apply_mask(candidate)
+        matrix.draw_format_bits(level, candidate)
+        score = matrix.penalty() if mask is None else 0
+        if best is None or score < best[0]:
+            best = (score, matrix)
+    return best[1].modules
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+# 1-bit grayscale PNG: `scale` pixels per module, `border` light modules of quiet zone.
+# Each module row is written once; the `scale - 1` copies below it use the Up filter (all zeros)
+def png_bytes(modules, scale=8, border=4):
+    width = (len(modules) + 2 * border) * scale
+    row_bytes = (width + 7) // 8
+    repeat = (b"\x02" + b"\x00" * row_bytes) * (scale - 1)
+    light_row = b"\x00" + b"\xff" * row_bytes
+    quiet = light_row + (b"\x02" + b"\x00" * row_bytes) * (border * scale - 1) if border else b""
+    rows = [quiet]
+    for row in modules:
+        bits = "1" * (border * scale)
+        for dark in row:
+            bits += ("0" if dark else "1") * scale
+        bits += "1" * (border * scale + row_bytes * 8 - width)
+        rows.append(b"\x00" + int(bits, 2).to_bytes(row_bytes, "big") + repeat)
+    rows.append(quiet)
+    header = struct.pack(">IIBBBBB", width, width, 1, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", header)
+        + png_chunk(b"IDAT", zlib.compress(b"".join(rows), 9))
+        + png_chunk(b"IEND", b"")
+    )
+
+def qr_png(data, level="L", scale=8, border=4):
+    return png_bytes(qr_matrix(data, level), scale, border)
@@ -2,21 +2,39 @@
 
 # Import modules
 # subprocess: for running `wg show`, `rm`, `shutdown`
-# re: for parsing handshake time
 # time: for timestamp
 # os: for file checks
+# json, urllib.request: for posting lifecycle events to the bot
+# re, statistics: for parsing ping round-trip times
 import subprocess
-import re
 import time
 import os
+import json
+import urllib.request
+import re
+import statistics
 
 # Constants
 # PEERS_DIR: directory for peer files
 # LOG_FILE: log file path
 # HANDSHAKE_THRESHOLD: handshake threshold (60 minutes = 3600 seconds)
+# METRICS_FILE: Prometheus textfile for node_exporter's textfile collector
+# NOTIFY_URL: bot webhook URL (API Gateway) for lifecycle events, empty to disable
+# NOTIFY_SECRET: shared secret, must match MONITOR_SECRET in the Lambda environment
+# NOTIFY_TENANT: tenant name in the bot's tenants.json, empty for a single-tenant bot
+# IDLE_NOTICE_AFTER: idle seconds before "idle countdown started" is posted
+# RESUME_GAP: a gap this long between runs means the instance resumed from hibernation
+# LATENCY_NOTICE_EVERY: seconds between peer round-trip time reports, while peers are active
 PEERS_DIR = "/home/ubuntu/wireguard/wireguard"
 LOG_FILE = "/tmp/wg_check.log"
 HANDSHAKE_THRESHOLD = 3600
+METRICS_FILE = "/var/lib/node_exporter/textfile_collector/wg_check.prom"
+NOTIFY_URL = ""
+NOTIFY_SECRET = "YOUR_MONITOR_SECRET_HERE"
+NOTIFY_TENANT = ""
+IDLE_NOTICE_AFTER = 300
+RESUME_GAP = 600
+LATENCY_NOTICE_EVERY = 1800
 
 # Logging function
 def log(message):
@@ -26,65 +44,219 @@ def log(message):
     except Exception as e:
         pass  # Silently ignore logging errors
 
+# Metrics function: write the .prom file atomically (temp file + rename),
+# so node_exporter never scrapes a half-written file
+def write_metrics(lines):
+    tmp_file = f"{METRICS_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, METRICS_FILE)
+    except Exception as e:
+        log(f"Error writing metrics: {e}")
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+# Notify function: post a lifecycle event to the bot, so the chat hears
+# about it without polling (errors are logged, never fatal)
+def notify(event, **fields):
+    if not NOTIFY_URL:
+        return
+    if NOTIFY_TENANT:
+        fields["tenant"] = NOTIFY_TENANT
+    payload = json.dumps({"monitor_event": event, "time": int(time.time()), **fields}).encode()
+    request = urllib.request.Request(
+        NOTIFY_URL,
+        data=payload,
+        headers={"Content-Type": "application/json", "X-Monitor-Secret": NOTIFY_SECRET}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            log(f"notify {event}: HTTP {response.status}")
+    except Exception as e:
+        log(f"Error notifying {event}: {e}")
+
+# Region function: from instance metadata (IMDSv2), so the bot knows where a latency sample was taken
+def instance_region():
+    try:
+        token_request = urllib.request.Request(
+            "http://169.254.169.254/latest/api/token",
+            method="PUT",
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"}
+        )
+        with urllib.request.urlopen(token_request, timeout=2) as response:
+            token = response.read().decode()
+        region_request = urllib.request.Request(
+            "http://169.254.169.254/latest/meta-data/placement/region",
+            headers={"X-aws-ec2-metadata-token": token}
+        )
+        with urllib.request.urlopen(region_request, timeout=2) as response:
+            return response.read().decode()
+    except Exception as e:
+        log(f"Error reading region: {e}")
+        return ""
+
+# RTT function: ping a peer's tunnel address from the wireguard container, so the
+# time includes the peer's path to this region (None if the peer does not answer)
+def peer_rtt(address):
+    result = subprocess.run(
+        ["docker", "exec", "wireguard", "ping", "-c", "3", "-W", "1", "-q", address],
+        capture_output=True,
+        text=True
+    )
+    # iputils: "rtt min/avg/max/mdev = ...", busybox: "round-trip min/avg/max = ..."
+    match = re.search(r"= [\d.]+/([\d.]+)/", result.stdout)
+    return float(match.group(1)) if match else None
+
 # Timestamp
 timestamp = int(time.time())
+check_started = time.monotonic()
 log(f"Script started, timestamp={timestamp}")
 
 # Check the time of the last run
 last_run_file = "/tmp/wg_last_run"
+up_notified_file = "/tmp/wg_up_notified"
 if os.path.exists(last_run_file):
     with open(last_run_file, "r") as f:
         last_run = int(f.read().strip())
     if timestamp - last_run < 60:
         log(f"Too frequent run, skipping (last_run={last_run})")
         exit(0)
+    # /tmp survives hibernation, so a long gap is the only sign of a resume
+    if timestamp - last_run > RESUME_GAP and os.path.exists(up_notified_file):
+        log(f"Resumed after {timestamp - last_run} seconds, announcing WireGuard again")
+        os.remove(up_notified_file)
 with open(last_run_file, "w") as f:
     f.write(str(timestamp))
 
-# Run `wg show`
+# Run `wg show all dump` (tab-separated: handshake epochs and byte counters)
 try:
+    exec_started = time.monotonic()
     wg_output = subprocess.run(
-        ["docker", "exec", "wireguard", "wg", "show"],
+        ["docker", "exec", "wireguard", "wg", "show", "all", "dump"],
         capture_output=True,
         text=True
     ).stdout
-    log(f"wg show: {wg_output[:100]}...")
+    docker_exec_seconds = time.monotonic() - exec_started
+    # The interface lines carry the private key, so only log the size
+    log(f"wg show: {len(wg_output.splitlines())} lines in {docker_exec_seconds:.3f}s")
 except Exception as e:
     log(f"Error running wg show: {e}")
     exit(1)
 
-# Parse `wg show` output
-current_peer = None
+# Parse `wg show all dump` output
+# Peer lines: interface, public key, preshared key, endpoint, allowed ips,
+# latest handshake (epoch, 0 = never), rx bytes, tx bytes, keepalive
+peers = []  # (interface, public key, handshake epoch, rx bytes, tx bytes)
+active_addresses = []  # Tunnel addresses of the active peers
+active_peers = 0
 all_peers_inactive = True  # Flag: all peers are inactive
 
 for line in wg_output.splitlines():
-    if line.startswith("peer:"):
-        current_peer = line.split("peer: ")[1].strip()
-        log(f"Starting peer: {current_peer}")
-    elif "latest handshake:" in line and current_peer:
-        match = re.search(r"latest handshake:\s*(.+)", line)
-        if match:
-            handshake_time = match[1].strip()
-            if handshake_time == "0 seconds ago":
-                seconds = 0
-            else:
-                # Parse handshake time (e.g., "1 hour, 2 minutes, 34 seconds ago")
-                seconds = 0
-                if "hour" in handshake_time:
-                    hours = int(re.search(r"(\d+)\s*hour", handshake_time).group(1))
-                    seconds += hours * 3600
-                if "minute" in handshake_time:
-                    minutes = int(re.search(r"(\d+)\s*minute", handshake_time).group(1))
-                    seconds += minutes * 60
-                if "second" in handshake_time:
-                    seconds_match = re.search(r"(\d+)\s*second", handshake_time)
-                    if seconds_match:
-                        seconds += int(seconds_match.group(1))
-            
-            log(f"Peer {current_peer}: latest handshake {seconds} seconds ago")
-            if seconds < HANDSHAKE_THRESHOLD:
-                all_peers_inactive = False
-                log(f"Peer {current_peer} is active (handshake younger than {HANDSHAKE_THRESHOLD} seconds)")
+    fields = line.split("\t")
+    if len(fields) != 9:
+        continue  # Interface line
+    interface, current_peer = fields[0], fields[1]
+    handshake_epoch = int(fields[5])
+    peers.append((interface, current_peer, handshake_epoch, int(fields[6]), int(fields[7])))
+    log(f"Starting peer: {current_peer}")
+    if handshake_epoch == 0:
+        log(f"Peer {current_peer}: no handshake")
+        continue
+
+    seconds = timestamp - handshake_epoch
+    log(f"Peer {current_peer}: latest handshake {seconds} seconds ago")
+    if seconds < HANDSHAKE_THRESHOLD:
+        all_peers_inactive = False
+        active_peers += 1
+        active_addresses.append(fields[4].split(",")[0].split("/")[0])
+        log(f"Peer {current_peer} is active (handshake younger than {HANDSHAKE_THRESHOLD} seconds)")
+
+# Export metrics before acting on them (a shutdown may follow)
+# The idle countdown starts at the most recent handshake of any peer
+metrics = [
+    "# HELP wg_peer_last_handshake_seconds Unix time of the peer's latest handshake (0 if none).",
+    "# TYPE wg_peer_last_handshake_seconds gauge",
+]
+for interface, public_key, handshake_epoch, rx_bytes, tx_bytes in peers:
+    metrics.append(f'wg_peer_last_handshake_seconds{{interface="{interface}",public_key="{public_key}"}} {handshake_epoch}')
+metrics += [
+    "# HELP wg_peer_receive_bytes_total Bytes received from the peer.",
+    "# TYPE wg_peer_receive_bytes_total counter",
+]
+for interface, public_key, handshake_epoch, rx_bytes, tx_bytes in peers:
+    metrics.append(f'wg_peer_receive_bytes_total{{interface="{interface}",public_key="{public_key}"}} {rx_bytes}')
+metrics += [
+    "# HELP wg_peer_transmit_bytes_total Bytes sent to the peer.",
+    "# TYPE wg_peer_transmit_bytes_total counter",
+]
+for interface, public_key, handshake_epoch, rx_bytes, tx_bytes in peers:
+    metrics.append(f'wg_peer_transmit_bytes_total{{interface="{interface}",public_key="{public_key}"}} {tx_bytes}')
+metrics += [
+    "# HELP wg_active_peers Peers with a handshake younger than the idle threshold.",
+    "# TYPE wg_active_peers gauge",
+    f"wg_active_peers {active_peers}",
+    "# HELP wg_docker_exec_duration_seconds Latency of the docker exec running wg show.",
+    "# TYPE wg_docker_exec_duration_seconds gauge",
+    f"wg_docker_exec_duration_seconds {docker_exec_seconds:.6f}",
+]
+last_handshake = max((peer[2] for peer in peers), default=0)
+if last_handshake:
+    metrics += [
+        "# HELP wg_idle_seconds Time since the idle countdown started (latest handshake of any peer).",
+        "# TYPE wg_idle_seconds gauge",
+        f"wg_idle_seconds {timestamp - last_handshake}",
+    ]
+metrics += [
+    "# HELP wg_check_duration_seconds Duration of the check run.",
+    "# TYPE wg_check_duration_seconds gauge",
+    f"wg_check_duration_seconds {time.monotonic() - check_started:.6f}",
+]
+write_metrics(metrics)
+
+# First run after boot (/tmp is cleared on reboot) or resume: tell the bot WireGuard is up
+if wg_output and not os.path.exists(up_notified_file):
+    notify("wireguard_up", peers=len(peers))
+    with open(up_notified_file, "w") as f:
+        f.write(str(timestamp))
+
+# Idle countdown: post once per countdown (keyed by the handshake that started it)
+idle_notified_file = "/tmp/wg_idle_notified"
+if last_handshake and not all_peers_inactive and timestamp - last_handshake >= IDLE_NOTICE_AFTER:
+    idle_notified = None
+    if os.path.exists(idle_notified_file):
+        with open(idle_notified_file, "r") as f:
+            idle_notified = f.read().strip()
+    if idle_notified != str(last_handshake):
+        notify(
+            "idle_countdown_started",
+            idle_seconds=timestamp - last_handshake,
+            shutdown_in=HANDSHAKE_THRESHOLD - (timestamp - last_handshake)
+        )
+        with open(idle_notified_file, "w") as f:
+            f.write(str(last_handshake))
+
+# Peer latency: the bot starts the instance in the region with the lowest median RTT
+latency_notified_file = "/tmp/wg_latency_notified"
+if NOTIFY_URL and active_addresses:
+    latency_notified = 0
+    if os.path.exists(latency_notified_file):
+        with open(latency_notified_file, "r") as f:
+            latency_notified = int(f.read().strip() or 0)
+    if timestamp - latency_notified >= LATENCY_NOTICE_EVERY:
+        try:
+            rtts = [rtt for rtt in map(peer_rtt, active_addresses) if rtt is not None]
+        except Exception as e:
+            log(f"Error measuring peer RTT: {e}")
+            rtts = []
+        if rtts:
+            notify("latency", rtt_ms=round(statistics.median(rtts), 1), peers=len(rtts), region=instance_region())
+            with open(latency_notified_file, "w") as f:
+                f.write(str(timestamp))
+        else:
+            log("No active peer answered ping, no latency sample")
 
 # If no handshake is found for a peer, consider it inactive
 if all_peers_inactive:
@@ -97,8 +269,11 @@ if all_peers_inactive:
             text=True
         )
         log(f"rm result: code={rm_result.returncode}, stderr={rm_result.stderr}")
-        
-        # Shut down the instance
+        if rm_result.returncode == 0:
+            notify("peers_deleted")
+
+        # Shut down the instance (post first, the network goes down with it)
+        notify("shutting_down")
         shutdown_result = subprocess.run(
             ["sudo", "/sbin/shutdown", "now"],
             capture_output=True,